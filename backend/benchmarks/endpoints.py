@@ -0,0 +1,217 @@
+"""
+Endpoint latency and throughput against a synthetic question bank.
+
+For every bank size the database is emptied, migrated to the Alembic head
+(so the full-text column, its trigger and the trigram index exist on
+PostgreSQL, as in production) and seeded with that many questions spread
+over --categories categories, then each scenario sends
+--requests requests through the Flask test client (in process, so network
+and WSGI server time are not included) and records p50/p99/mean latency
+and throughput:
+
+    questions_first_page    GET /questions
+    questions_deep_page     GET /questions?page=<last>
+    questions_cursor        GET /questions?after=<middle of the bank>
+    category_questions      GET /categories/<random>/questions
+    categories              GET /categories
+    search                  POST /questions {"searchTerm": <random word>}
+    quiz                    POST /quizzes with --previous previous_questions
+    insert                  POST /questions
+    delete                  DELETE /questions/<id> of an inserted question
+
+Results are written as JSON (with the git commit they were measured at) so
+two runs can be compared:
+
+    python benchmarks/endpoints.py --sizes 1000,100000 --output before.json
+    python benchmarks/endpoints.py --sizes 1000,100000 --output after.json
+    python benchmarks/endpoints.py --compare before.json after.json
+
+Run from the backend folder. The database given by --database-url is
+dropped and recreated: never point it at real data.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bulk import insert_rows
+from flask_migrate import upgrade
+from sqlalchemy import MetaData
+
+from flaskr import MIGRATIONS_DIRECTORY, create_app, encode_cursor
+from models import Category, db
+
+DEFAULT_DATABASE_URL = 'sqlite:////tmp/trivia_benchmark.db'
+SEED_BATCH_SIZE = 100000
+WORDS = (
+    'river', 'planet', 'painter', 'empire', 'volcano', 'symphony', 'island', 'theorem',
+    'desert', 'novel', 'molecule', 'glacier', 'dynasty', 'comet', 'sculpture', 'reactor',
+)
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def synthetic_rows(start, count, category_ids):
+    rng = random.Random(start)
+    rows = []
+    for number in range(start, start + count):
+        words = rng.sample(WORDS, 3)
+        rows.append({
+            'question': f'Which {words[0]} is linked to the {words[1]} and the {words[2]}? (#{number})',
+            'answer': f'The {words[0]} {number}',
+            'category': category_ids[number % len(category_ids)],
+            'difficulty': number % 5 + 1,
+        })
+    return rows
+
+
+def seed(app, size, categories):
+    with app.app_context():
+        # every table, alembic_version included, so the upgrade starts from scratch
+        tables = MetaData()
+        tables.reflect(db.engine)
+        tables.drop_all(db.engine)
+        upgrade(directory=MIGRATIONS_DIRECTORY)
+        db.session.add_all([Category(type=f'Category {number}') for number in range(1, categories + 1)])
+        db.session.commit()
+        category_ids = [category.id for category in Category.query.order_by(Category.id)]
+        for start in range(0, size, SEED_BATCH_SIZE):
+            insert_rows(synthetic_rows(start, min(SEED_BATCH_SIZE, size - start), category_ids))
+        return category_ids
+
+
+def measure(send, requests, warmup):
+    for _ in range(warmup):
+        send()
+    durations = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = send()
+        durations.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{response.request.method} {response.request.path} returned {response.status_code}')
+    durations.sort()
+    return {
+        'requests': requests,
+        'p50_ms': round(durations[len(durations) // 2] * 1000, 3),
+        'p99_ms': round(durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000, 3),
+        'mean_ms': round(statistics.fmean(durations) * 1000, 3),
+        'throughput_rps': round(len(durations) / sum(durations), 1),
+    }
+
+
+def scenarios(client, size, category_ids, previous):
+    rng = random.Random(size)
+    last_page = max(1, -(-size // 10))
+    sample_ids = rng.sample(range(1, size + 1), min(previous, size))
+    created = []
+
+    def insert():
+        response = client.post('/questions', json={
+            'question': 'Benchmark question?', 'answer': 'Benchmark answer',
+            'category': rng.choice(category_ids), 'difficulty': 3,
+        })
+        created.append(response.get_json()['created'])
+        return response
+
+    def delete():
+        return client.delete(f'/questions/{created.pop()}')
+
+    return [
+        ('questions_first_page', lambda: client.get('/questions')),
+        ('questions_deep_page', lambda: client.get(f'/questions?page={last_page}')),
+        ('questions_cursor', lambda: client.get(f'/questions?after={encode_cursor(size // 2)}')),
+        ('category_questions', lambda: client.get(f'/categories/{rng.choice(category_ids)}/questions')),
+        ('categories', lambda: client.get('/categories')),
+        ('search', lambda: client.post('/questions', json={'searchTerm': rng.choice(WORDS)})),
+        ('quiz', lambda: client.post('/quizzes', json={
+            'previous_questions': sample_ids,
+            'quiz_category': {'id': rng.choice(category_ids), 'type': 'any'},
+        })),
+        ('insert', insert),
+        ('delete', delete),
+    ]
+
+
+def run(args):
+    commit, dirty = git_commit()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'database': args.database_url.split(':', 1)[0],
+        'requests': args.requests,
+        'results': [],
+    }
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url})
+    client = app.test_client()
+
+    for size in args.sizes:
+        started = time.perf_counter()
+        category_ids = seed(app, size, args.categories)
+        print(f'seeded {size} questions in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+        for name, send in scenarios(client, size, category_ids, args.previous):
+            # delete removes what insert created, so it gets the same count
+            warmup = 0 if name in ('insert', 'delete') else args.warmup
+            result = {'size': size, 'scenario': name, **measure(send, args.requests, warmup)}
+            report['results'].append(result)
+            print(f"{size:>9} {name:<22} p50 {result['p50_ms']:>9.3f} ms  p99 {result['p99_ms']:>9.3f} ms  "
+                  f"{result['throughput_rps']:>9.1f} req/s", file=sys.stderr)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    print(f'results written to {args.output}', file=sys.stderr)
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    baseline = {(result['size'], result['scenario']): result for result in before['results']}
+
+    print(f"before {before['commit']}, after {after['commit']}")
+    print(f"{'size':>9} {'scenario':<22} {'p50 before':>11} {'p50 after':>10} {'change':>8} {'p99 change':>11}")
+    for result in after['results']:
+        old = baseline.get((result['size'], result['scenario']))
+        if old is None:
+            continue
+        p50_change = (result['p50_ms'] / old['p50_ms'] - 1) * 100
+        p99_change = (result['p99_ms'] / old['p99_ms'] - 1) * 100
+        print(f"{result['size']:>9} {result['scenario']:<22} {old['p50_ms']:>11.3f} {result['p50_ms']:>10.3f} "
+              f"{p50_change:>+7.1f}% {p99_change:>+10.1f}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('BENCHMARK_DATABASE_URL', DEFAULT_DATABASE_URL))
+    parser.add_argument('--sizes', default='1000,100000,1000000')
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--previous', type=int, default=500, help='length of previous_questions in the quiz scenario')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        args.sizes = [int(size) for size in args.sizes.split(',')]
+        run(args)
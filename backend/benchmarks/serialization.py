@@ -0,0 +1,91 @@
+"""
+Per-page serialization cost of a GET /questions response, before and after
+the fast JSON path:
+
+    before - Question.format() dicts encoded by Flask's stdlib provider
+    after  - row tuples encoded by json_provider.question_rows_json and
+             FastJSONProvider (orjson when installed)
+
+Both go through provider.response(), as jsonify does, so the arguments
+Flask passes to dumps (compact separators) are part of the measurement.
+
+Run from the backend folder:
+
+    python benchmarks/serialization.py [--pages 2000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import json_provider
+from json_provider import FastJSONProvider, question_rows_json
+from models import Question
+
+CATEGORIES = {1: 'Science', 2: 'Art', 3: 'Geography', 4: 'History', 5: 'Entertainment', 6: 'Sports'}
+
+
+def make_rows(page_size):
+    return [
+        (
+            question_id,
+            f'What is the answer to synthetic question number {question_id}?',
+            f'Answer {question_id}',
+            question_id % 6 + 1,
+            question_id % 5 + 1,
+        )
+        for question_id in range(1, page_size + 1)
+    ]
+
+
+def page_payload(questions, total):
+    return {
+        'success': True,
+        'questions': questions,
+        'total_questions': total,
+        'current_category': None,
+        'categories': CATEGORIES,
+    }
+
+
+def run(page_sizes, pages):
+    app = Flask(__name__)
+    stdlib_provider = DefaultJSONProvider(app)
+    fast_provider = FastJSONProvider(app)
+    encoder = 'orjson' if json_provider.orjson is not None else 'stdlib'
+
+    print(f'fast path encoder: {encoder}, {pages} pages per measurement')
+    print(f"{'page size':>10} {'before us/page':>15} {'after us/page':>14} {'speedup':>8}")
+    for page_size in page_sizes:
+        rows = make_rows(page_size)
+        objects = [
+            Question(question=question, answer=answer, category=category, difficulty=difficulty)
+            for _, question, answer, category, difficulty in rows
+        ]
+        for question, row in zip(objects, rows):
+            question.id = row[0]
+
+        def before():
+            return stdlib_provider.response(page_payload([question.format() for question in objects], 1000)).get_data()
+
+        def after():
+            return fast_provider.response(page_payload(question_rows_json(rows, fast_provider.encode_string), 1000)).get_data()
+
+        with app.app_context():
+            assert stdlib_provider.loads(before()) == stdlib_provider.loads(after())
+            before_us = min(timeit.repeat(before, number=pages, repeat=3)) / pages * 1e6
+            after_us = min(timeit.repeat(after, number=pages, repeat=3)) / pages * 1e6
+        print(f'{page_size:>10} {before_us:>15.1f} {after_us:>14.1f} {before_us / after_us:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--page-sizes', default='10,100')
+    args = parser.parse_args()
+    run([int(size) for size in args.page_sizes.split(',')], args.pages)
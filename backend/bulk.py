@@ -0,0 +1,169 @@
+import csv
+import io
+import json
+from collections import Counter
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import insert
+
+from models import Category, Question, db, adjust_category_stats, bump_data_version
+
+"""
+Bulk question import, shared by POST /questions/bulk and
+`flask import-questions`.
+
+Rows are validated as a batch up front and the valid ones are inserted in
+a single transaction: with PostgreSQL COPY when the driver supports it,
+otherwise with one executemany INSERT per batch.
+"""
+BULK_FIELDS = ('question', 'answer', 'category', 'difficulty')
+BULK_BATCH_SIZE = 5000
+ON_ERROR_MODES = ('skip', 'abort')
+
+
+def parse_json_rows(data):
+    rows = json.loads(data)
+    if not isinstance(rows, list):
+        raise ValueError('expected a JSON array of questions')
+    return rows
+
+
+def parse_ndjson_rows(lines):
+    """
+    Yields one row per non-blank line. A line that is not valid JSON is
+    yielded as the exception so it is reported against its row number.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield e
+
+
+def validate_row(row, category_ids):
+    """
+    Returns the insertable values of a row, or raises ValueError.
+    """
+    if isinstance(row, Exception):
+        raise ValueError(f'invalid JSON: {row}')
+    if not isinstance(row, dict):
+        raise ValueError('expected an object')
+
+    values = {}
+    for field in ('question', 'answer'):
+        value = row.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f'{field} must be a non-empty string')
+        values[field] = value
+    for field in ('category', 'difficulty'):
+        value = row.get(field)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise ValueError(f'{field} must be a positive integer')
+        values[field] = value
+    if values['category'] not in category_ids:
+        raise ValueError(f"category {values['category']} does not exist")
+    return values
+
+
+def validate_rows(rows, category_ids):
+    """
+    Splits rows into the valid values and a list of per-row errors
+    (row numbers count from 0).
+    """
+    valid, errors = [], []
+    for number, row in enumerate(rows):
+        try:
+            valid.append(validate_row(row, category_ids))
+        except ValueError as e:
+            errors.append({'row': number, 'error': str(e)})
+    return valid, errors
+
+
+def copy_rows(cursor, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[field] for field in BULK_FIELDS])
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY questions ({', '.join(BULK_FIELDS)}) FROM STDIN WITH (FORMAT csv)",
+        buffer
+    )
+
+
+def insert_rows(rows, batch_size=BULK_BATCH_SIZE):
+    """
+    Inserts validated rows in one transaction, updates the category stats
+    and bumps the data version.
+    """
+    connection = db.session.connection()
+    cursor = None
+    if connection.dialect.name == 'postgresql':
+        cursor = connection.connection.cursor()
+        if not hasattr(cursor, 'copy_expert'):
+            # COPY FROM STDIN here is psycopg2's API
+            cursor = None
+    try:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            if cursor is not None:
+                copy_rows(cursor, batch)
+            else:
+                db.session.execute(insert(Question.__table__), batch)
+        # neither COPY nor Core inserts fire the Question mapper events
+        adjust_category_stats(connection, Counter((row['category'], row['difficulty']) for row in rows))
+        bump_data_version()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def import_questions(rows, on_error='skip'):
+    """
+    Validates and inserts rows. With on_error='abort' nothing is inserted
+    when any row is invalid. Returns the number of inserted rows and the
+    per-row errors.
+    """
+    # read from the database rather than category_cache, which may not know
+    # a category another worker created within its TTL
+    category_ids = {category_id for (category_id,) in db.session.query(Category.id)}
+    valid, errors = validate_rows(rows, category_ids)
+    if errors and on_error == 'abort':
+        return 0, errors
+    if valid:
+        insert_rows(valid)
+    return len(valid), errors
+
+
+@click.command('import-questions')
+@click.argument('source', type=click.File('rb'))
+@click.option('--format', 'source_format', type=click.Choice(['json', 'ndjson']),
+              help='Defaults to ndjson for .ndjson/.jsonl files and stdin, json otherwise.')
+@click.option('--on-error', type=click.Choice(ON_ERROR_MODES), default='skip', show_default=True)
+@with_appcontext
+def import_questions_command(source, source_format, on_error):
+    """Bulk import questions from a JSON array or NDJSON file ('-' for stdin)."""
+    if source_format is None:
+        name = getattr(source, 'name', '-')
+        source_format = 'ndjson' if name in ('-', '<stdin>') or name.endswith(('.ndjson', '.jsonl')) else 'json'
+
+    if source_format == 'ndjson':
+        rows = parse_ndjson_rows(source)
+    else:
+        try:
+            rows = parse_json_rows(source.read())
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    inserted, errors = import_questions(rows, on_error)
+    for error in errors:
+        click.echo(f"row {error['row']}: {error['error']}", err=True)
+    if errors and on_error == 'abort':
+        raise click.ClickException(f'{len(errors)} rows rejected, nothing inserted')
+    click.echo(f'inserted {inserted} questions, {len(errors)} rows rejected')
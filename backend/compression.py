@@ -0,0 +1,117 @@
+import gzip
+import threading
+from collections import OrderedDict
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+"""
+Negotiated response compression, applied in the after_request pipeline.
+
+gzip is always available; br and zstd are offered when the brotli /
+zstandard packages are installed. Bodies smaller than COMPRESS_MIN_SIZE
+bytes are sent as they are. Compressed bodies of ETag'd responses are
+cached per URL, ETag and encoding, so repeated pages are only compressed
+once per data version.
+"""
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 500
+COMPRESS_CACHE_SIZE = 256
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv'}
+# every encoding this module knows, preferred first
+ENCODINGS = ('zstd', 'br', 'gzip')
+
+
+def available_encodings():
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+def etag_variants(etag):
+    """
+    The ETag and its per-encoding variants (a compressed body is a different
+    representation, so it gets a different strong ETag).
+    """
+    return [etag] + [f'{etag}-{encoding}' for encoding in ENCODINGS]
+
+
+def compress(data, encoding, level):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=min(level, 9))
+
+
+"""
+CompressionCache
+    bounded LRU map of (url, etag, encoding) -> compressed body
+"""
+class CompressionCache:
+
+    def __init__(self, max_entries=COMPRESS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def compress_response(response):
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None or encoding == 'identity':
+        return response
+
+    config = current_app.config
+    data = response.get_data()
+    if len(data) < config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE):
+        return response
+
+    etag, _ = response.get_etag()
+    cache = current_app.extensions['compression_cache']
+    key = (request.full_path, etag, encoding) if etag and request.method == 'GET' else None
+    body = cache.get(key) if key else None
+    if body is None:
+        body = compress(data, encoding, config.get('COMPRESS_LEVEL', COMPRESS_LEVEL))
+        if key:
+            cache.put(key, body)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(f'{etag}-{encoding}')
+    return response
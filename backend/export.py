@@ -0,0 +1,67 @@
+import csv
+import io
+import json
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from models import Question, db
+
+"""
+Streaming export of the question bank, shared by GET /questions/export and
+`flask export-questions`.
+
+Rows come from a server-side cursor (yield_per) and leave as text chunks
+of EXPORT_BATCH_SIZE rows, so memory use does not depend on the bank size.
+"""
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_batches(batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields lists of (id, question, answer, category, difficulty) rows in id
+    order, fetched batch_size rows at a time.
+    """
+    statement = select(
+        Question.id, Question.question, Question.answer, Question.category, Question.difficulty
+    ).order_by(Question.id).execution_options(yield_per=batch_size)
+    result = db.session.execute(statement)
+    for partition in result.partitions():
+        yield partition
+
+
+def export_chunks(export_format, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields the export as text, one chunk per batch (CSV starts with a header).
+    """
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for batch in export_batches(batch_size):
+            writer.writerows(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        for batch in export_batches(batch_size):
+            yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n' for row in batch)
+
+
+@click.command('export-questions')
+@click.argument('output', type=click.File('w'), default='-')
+@click.option('--format', 'export_format', type=click.Choice(EXPORT_FORMATS), default='ndjson', show_default=True)
+@with_appcontext
+def export_questions_command(output, export_format):
+    """Stream every question to OUTPUT (stdout by default) as NDJSON or CSV."""
+    for chunk in export_chunks(export_format):
+        output.write(chunk)
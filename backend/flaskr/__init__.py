@@ -1,31 +1,315 @@
-from flask import Flask, request, abort, jsonify
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+from flask import Flask, request, abort, jsonify, Response, current_app, g, stream_with_context
 from flask_cors import CORS
-import random
-
-from models import setup_db, Question, Category, db
+from flask_migrate import Migrate
+from sqlalchemy import func
+import base64
+import functools
+import json
+import logging
+import os
+
+from models import (
+    setup_db,
+    schema_revision,
+    Question,
+    db,
+    category_cache,
+    get_data_version,
+    include_object,
+    pool_status,
+    category_stats_total,
+    category_question_counts,
+)
+from search import search_questions, SEARCH_MODES
+from json_provider import FastJSONProvider, question_rows_json
+from timing import init_timing
+from query_tracker import query_budget
+from question_bank import init_question_bank
+from metrics import init_metrics
+from compression import CompressionCache, compress_response, etag_variants, COMPRESS_CACHE_SIZE
+from bulk import (
+    import_questions,
+    import_questions_command,
+    parse_json_rows,
+    parse_ndjson_rows,
+    ON_ERROR_MODES,
+)
+from export import export_chunks, export_questions_command, EXPORT_FORMATS, EXPORT_MIMETYPES
+from settings import SCHEMA_CHECK
+from quiz import (
+    parse_quiz_category,
+    parse_previous_questions,
+    random_question,
+    build_deck,
+    QUIZ_DECK_SIZE,
+    MAX_QUIZ_DECK_SIZE,
+    MemoryQuizSessionStore,
+    QUIZ_SESSION_TTL,
+)
+
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
 
 QUESTIONS_PER_PAGE = 10
+# listings select plain row tuples and serialize them without ORM objects or dicts
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+MAX_QUESTIONS_PER_PAGE = 100
 
-def pagination_helper(request, selection):
-    page = request.args.get("page", 1, type=int)
+def page_size_helper(request):
     questions_per_page = request.args.get("questions_per_page", QUESTIONS_PER_PAGE, type=int)
+    if questions_per_page < 1 or questions_per_page > MAX_QUESTIONS_PER_PAGE:
+        abort(400)
+    return questions_per_page
+
+
+def pagination_helper(request, selection, total=None):
+    """
+    Paginates an (ordered) Question query in the database.
+    Returns the questions of the requested page (serialized straight from
+    row tuples, see json_provider.question_rows_json) and the total number
+    of questions matched by the query, or the result of the `total` SELECT
+    when one is given (e.g. models.category_stats_total()).
+    """
+    page = request.args.get("page", 1, type=int)
+    questions_per_page = page_size_helper(request)
+    if page < 1:
+        abort(400)
+    start = (page - 1) * questions_per_page
+
+    questions = selection.with_entities(*QUESTION_COLUMNS, total_column(selection, total)).limit(questions_per_page).offset(start).all()
+    current_questions = question_rows_json(questions, current_app.json.encode_string)
+    total_questions = page_total(selection, questions, start > 0, total)
+    return current_questions, total_questions
+
+
+def total_column(selection, total=None):
+    """
+    The total (by default the row count of the whole selection) as an
+    uncorrelated scalar subquery, so it comes back with the page in a
+    single statement.
+    """
+    if total is None:
+        total = selection.order_by(None).with_entities(func.count(Question.id)).statement
+    return total.correlate(None).scalar_subquery().label("total")
+
+
+def page_total(selection, rows, skipped, total=None):
+    """
+    The total carried by the page rows; an empty page past the first rows
+    has nothing to carry it, so the total then runs on its own.
+    """
+    if rows:
+        return rows[0].total
+    if not skipped:
+        return 0
+    if total is None:
+        return selection.order_by(None).count()
+    return db.session.execute(total).scalar()
+
+
+def encode_cursor(question_id):
+    payload = json.dumps({"id": question_id}).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the last seen question id of an `after` token, None for an
+    empty token (start of the list). Malformed tokens are a 400.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        question_id = json.loads(base64.urlsafe_b64decode(padded.encode()))["id"]
+    except Exception:
+        abort(400)
+    # bool is an int subclass: {"id": true} would seek after id 1
+    if isinstance(question_id, bool) or not isinstance(question_id, int):
+        abort(400)
+    return question_id
+
+
+def cursor_pagination_helper(request, selection, total=None):
+    """
+    Keyset pagination for a Question query ordered by Question.id.
+    Seeks past the id in the `after` token through the primary key index,
+    so deep pages cost the same as the first one.
+    Returns the serialized questions, the total count and the next cursor
+    (None on the last page).
+    """
+    questions_per_page = page_size_helper(request)
+    last_id = decode_cursor(request.args.get("after"))
+
+    seek = selection if last_id is None else selection.filter(Question.id > last_id)
+    # one extra row tells us whether there is a next page
+    questions = seek.with_entities(*QUESTION_COLUMNS, total_column(selection, total)).limit(questions_per_page + 1).all()
+    total_questions = page_total(selection, questions, last_id is not None, total)
+    next_cursor = None
+    if len(questions) > questions_per_page:
+        questions = questions[:questions_per_page]
+        next_cursor = encode_cursor(questions[-1].id)
+
+    current_questions = question_rows_json(questions, current_app.json.encode_string)
+    return current_questions, total_questions, next_cursor
+
+
+def paginate_questions(request, selection, total=None):
+    """
+    Returns the paginated `questions` and `total_questions` response fields,
+    using cursor mode (plus `next_cursor`) when the client passes `after`.
+    """
+    if "after" in request.args:
+        current_questions, total_questions, next_cursor = cursor_pagination_helper(request, selection, total)
+        return {
+            "questions": current_questions,
+            "total_questions": total_questions,
+            "next_cursor": next_cursor
+        }
+
+    current_questions, total_questions = pagination_helper(request, selection, total)
+    return {
+        "questions": current_questions,
+        "total_questions": total_questions
+    }
+
+
+def snapshot_pagination(request, snapshot, positions):
+    """
+    paginate_questions for the in-memory question bank: pages (or seeks,
+    with `after`) through snapshot positions instead of a query.
+    """
+    questions_per_page = page_size_helper(request)
+    encode_string = current_app.json.encode_string
+    if "after" in request.args:
+        last_id = decode_cursor(request.args.get("after"))
+        start = 0 if last_id is None else snapshot.seek(positions, last_id)
+        page_positions = positions[start:start + questions_per_page + 1]
+        next_cursor = None
+        if len(page_positions) > questions_per_page:
+            page_positions = page_positions[:questions_per_page]
+            next_cursor = encode_cursor(snapshot.ids[page_positions[-1]])
+        return {
+            "questions": question_rows_json(snapshot.rows(page_positions), encode_string),
+            "total_questions": len(positions),
+            "next_cursor": next_cursor
+        }
+
+    page = request.args.get("page", 1, type=int)
+    if page < 1:
+        abort(400)
     start = (page - 1) * questions_per_page
-    end = start + questions_per_page
+    page_positions = positions[start:start + questions_per_page]
+    return {
+        "questions": question_rows_json(snapshot.rows(page_positions), encode_string),
+        "total_questions": len(positions)
+    }
+
+
+def current_snapshot():
+    """
+    The in-memory question bank snapshot this request serves from (the same
+    one for its ETag and its body), None when the bank is disabled.
+    """
+    bank = current_app.extensions.get('question_bank')
+    if bank is None:
+        return None
+    if 'bank_snapshot' not in g:
+        g.bank_snapshot = bank.current()
+    return g.bank_snapshot
+
+
+def check_schema_version(app):
+    """
+    Optional boot check that the database is at the latest migration.
+    SCHEMA_CHECK is "off" (default), "warn" or "error". The check reads the
+    migration scripts and runs a single query on alembic_version; it does
+    not introspect the catalog.
+    """
+    mode = app.config.get('SCHEMA_CHECK', SCHEMA_CHECK)
+    if mode == 'off':
+        return
+
+    config = Config()
+    config.set_main_option('script_location', MIGRATIONS_DIRECTORY)
+    head = ScriptDirectory.from_config(config).get_current_head()
+    with app.app_context():
+        current = schema_revision()
+    if current == head:
+        return
+
+    message = f'database schema is at revision {current}, expected {head}; run `flask db upgrade`'
+    if mode == 'error':
+        raise RuntimeError(message)
+    logging.getLogger(__name__).warning(message)
+
 
-    formatted_questions = [question.format() for question in selection]
-    current_questions = formatted_questions[start:end]
-    return current_questions
+def conditional_get(view):
+    """
+    Tags the view's response with a strong ETag derived from the data version
+    and answers 304 Not Modified, without running the view, when the client
+    already holds the current version.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        snapshot = current_snapshot()
+        if snapshot:
+            etag = f"v{snapshot.version}"
+        else:
+            # category_cache checks its entry against this version
+            g.data_version = get_data_version()
+            etag = f"v{g.data_version}"
+        for variant in etag_variants(etag):
+            if request.if_none_match.contains_weak(variant):
+                response = Response(status=304)
+                response.set_etag(variant)
+                return response
+
+        response = view(*args, **kwargs)
+        if response.status_code == 200:
+            response.set_etag(etag)
+        return response
+    return wrapper
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True) # not sure if 2nd arg is necessary
+    app.json = FastJSONProvider(app)
     if test_config is None:
         setup_db(app)
     else:
+        app.config.from_mapping(test_config)
         database_path = test_config.get('SQLALCHEMY_DATABASE_URI')
         setup_db(app, database_path=database_path)
 
+    # `flask db upgrade` etc.; the schema is owned by migrations/
+    # SQLite cannot ALTER most things in place; batch mode recreates the table
+    Migrate(
+        app, db, directory=MIGRATIONS_DIRECTORY, include_object=include_object,
+        render_as_batch=app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite')
+    )
+
+    app.extensions['compression_cache'] = CompressionCache(
+        app.config.get('COMPRESS_CACHE_SIZE', COMPRESS_CACHE_SIZE)
+    )
+
+    app.cli.add_command(import_questions_command)
+    app.cli.add_command(export_questions_command)
+
+    quiz_sessions = app.config.get('QUIZ_SESSION_STORE') or MemoryQuizSessionStore(
+        ttl=app.config.get('QUIZ_SESSION_TTL', QUIZ_SESSION_TTL)
+    )
+    app.extensions['quiz_sessions'] = quiz_sessions
+
+    # IN_MEMORY_BANK: serve reads from an in-process snapshot
+    init_question_bank(app)
+
+    # after_request hooks run in reverse order: metrics last, then timing
+    init_metrics(app)
+    init_timing(app)
+
     """
     @DONE: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     """
@@ -41,10 +325,13 @@ def create_app(test_config=None):
         response.headers.add(
             "Access-Control-Allow-Headers", "GET, POST, PATCH, DELETE, OPTIONS"
         )
-        return response
+        # versioned responses may be stored but must be revalidated with If-None-Match
+        if response.get_etag()[0] is not None:
+            response.headers["Cache-Control"] = "no-cache"
+        return compress_response(response)
 
-    with app.app_context():
-        db.create_all()
+    # the schema is created and upgraded by `flask db upgrade`, never at boot
+    check_schema_version(app)
 
     """
     @DONE:
@@ -53,17 +340,22 @@ def create_app(test_config=None):
     """
 
     @app.route('/categories', methods=["GET"])
+    # data version, categories on a cold cache, category stats
+    @query_budget(3)
+    @conditional_get
     def get_categories():
-        categories = Category.query.order_by(Category.id).all()
-        formatted_categories = {category.id: category.type for category in categories}
-        #[category.format() for category in categories]
-        return jsonify(
-            {
-                "success": True,
-                "categories": formatted_categories,
-                "total": len(formatted_categories),
-            }
-        )
+        snapshot = current_snapshot()
+        formatted_categories = snapshot.category_types if snapshot else category_cache.types_by_id()
+        body = {
+            "success": True,
+            "categories": formatted_categories,
+            "total": len(formatted_categories),
+        }
+        if request.args.get("with_counts", "").lower() in ("1", "true", "yes"):
+            counts = snapshot.counts if snapshot else category_question_counts()
+            empty = {"total": 0, "by_difficulty": {}}
+            body["counts"] = {category_id: counts.get(category_id, empty) for category_id in formatted_categories}
+        return jsonify(body)
 
 
     """
@@ -79,20 +371,25 @@ def create_app(test_config=None):
     Clicking on the page numbers should update the questions.
     """
     @app.route('/questions', methods=["GET"])
+    # data version, page with its total, categories on a cold cache
+    @query_budget(3)
+    @conditional_get
     def get_questions():
-        questions = Question.query.order_by(Question.id).all()
-        current_questions = pagination_helper(request, questions)
+        snapshot = current_snapshot()
+        if snapshot:
+            page = snapshot_pagination(request, snapshot, snapshot.positions())
+        else:
+            selection = Question.query.order_by(Question.id)
+            page = paginate_questions(request, selection, category_stats_total())
 
-        if len(current_questions) == 0:
+        if len(page["questions"]) == 0:
             abort(404)
 
-        categories = Category.query.order_by(Category.type).all()
-        formatted_categories = {category.id: category.type for category in categories}
+        formatted_categories = snapshot.category_types_by_type if snapshot else category_cache.types_by_type()
 
         return jsonify({
             "success": True,
-            "questions": current_questions,
-            "total_questions": len(questions),
+            **page,
             "current_category": None,
             "categories": formatted_categories
         })
@@ -149,22 +446,32 @@ def create_app(test_config=None):
         body = request.get_json()
 
         if "searchTerm" in body:
-            search_term = body.get("searchTerm")
-            search_pattern = f'%{search_term}%'
+            search_term = body.get("searchTerm") or ""
+            search_mode = body.get("searchMode", None)
+            if search_mode is not None and search_mode not in SEARCH_MODES:
+                abort(400)
             try:
-                questions = Question.query.filter(Question.question.ilike(search_pattern)).all()
-                current_questions = pagination_helper(request, questions)
-
-                categories = Category.query.order_by(Category.type).all()
-                formatted_categories = {category.id: category.type for category in categories}                
+                snapshot = current_snapshot()
+                if snapshot:
+                    page = snapshot_pagination(request, snapshot, snapshot.search(search_term, search_mode))
+                    formatted_categories = snapshot.category_types_by_type
+                else:
+                    selection = search_questions(search_term, search_mode)
+                    # an empty term matches every question
+                    total = None if search_term else category_stats_total()
+                    current_questions, total_questions = pagination_helper(request, selection, total)
+                    page = {"questions": current_questions, "total_questions": total_questions}
+                    formatted_categories = category_cache.types_by_type()
                 return jsonify({
                     "success": True,
-                    "questions": current_questions,
-                    "total_questions": len(questions),
+                    "questions": page["questions"],
+                    "total_questions": page["total_questions"],
                     "current_category": None,
                     "categories": formatted_categories
                 })
             except Exception as e:
+                if hasattr(e, 'code') and e.code == 400:
+                    abort(400)
                 abort(422)
         else:
             form_question = body.get("question", None)
@@ -184,6 +491,53 @@ def create_app(test_config=None):
             except Exception as e:
                 abort(422)
 
+    @app.route("/questions/export", methods=["GET"])
+    def export_questions():
+        export_format = request.args.get("format", "ndjson")
+        if export_format not in EXPORT_FORMATS:
+            abort(400)
+
+        response = Response(
+            stream_with_context(export_chunks(export_format)),
+            mimetype=EXPORT_MIMETYPES[export_format]
+        )
+        response.headers["Content-Disposition"] = f"attachment; filename=questions.{export_format}"
+        return response
+
+    @app.route("/questions/bulk", methods=["POST"])
+    def bulk_import_questions():
+        on_error = request.args.get("on_error", "skip")
+        if on_error not in ON_ERROR_MODES:
+            abort(400)
+
+        try:
+            if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+                rows = parse_ndjson_rows(request.stream)
+            else:
+                rows = parse_json_rows(request.get_data())
+        except ValueError:
+            abort(400)
+
+        try:
+            inserted, errors = import_questions(rows, on_error)
+        except Exception:
+            abort(422)
+
+        if errors and on_error == "abort":
+            return jsonify({
+                "success": False,
+                "message": "unprocessable",
+                "error": "422",
+                "inserted": 0,
+                "errors": errors
+            }), 422
+
+        return jsonify({
+            "success": True,
+            "inserted": inserted,
+            "errors": errors
+        })
+
     """
     @DONE:
     Create a GET endpoint to get questions based on category.
@@ -194,18 +548,29 @@ def create_app(test_config=None):
     """
 
     @app.route('/categories/<int:category_id>/questions', methods=["GET"])
+    # data version, categories (on a cold cache or for an id it does not know), page with its total
+    @query_budget(3)
+    @conditional_get
     def get_questions_by_category(category_id):
-        questions = Question.query.filter(Question.category == category_id).all()
-        current_questions = pagination_helper(request, questions)
-
-        category = Category.query.filter(Category.id == category_id).one_or_none()
-        if category is None:
+        snapshot = current_snapshot()
+        # unknown categories are a 404 before any question is queried
+        if snapshot:
+            category_type = snapshot.category_types.get(category_id)
+        else:
+            category_type = category_cache.get_type(category_id)
+        if category_type is None:
             abort(404)
+
+        if snapshot:
+            page = snapshot_pagination(request, snapshot, snapshot.positions(category_id))
+        else:
+            # the page is served by ix_questions_category_id, its total by category_stats
+            selection = Question.query.filter(Question.category == category_id).order_by(Question.id)
+            page = paginate_questions(request, selection, category_stats_total(category_id))
         return jsonify({
                 "success": True,
-                "questions": current_questions,
-                "total_questions": len(questions),
-                "current_category": category.type,
+                **page,
+                "current_category": category_type,
             })
 
     """
@@ -223,21 +588,18 @@ def create_app(test_config=None):
     @app.route('/quizzes', methods=["POST"])
     def play_quiz():
         body = request.get_json()
-        print("DEBUG - full request body: ", body)
-        
-        previous_questions = body.get('previous_questions', [])
-        quiz_category = body.get('quiz_category', None)
 
         try:
-            if quiz_category and quiz_category['id'] != 0:
-                questions = Question.query.filter(Question.category == quiz_category['id']).all()
-            else:
-                questions = Question.query.all()
-            remaining_questions = [q for q in questions if q.id not in previous_questions]
-            if remaining_questions:
-                current_question = random.choice(remaining_questions).format()
+            category_id = parse_quiz_category(body.get('quiz_category', None))
+            previous_questions = parse_previous_questions(body.get('previous_questions', []))
+
+            snapshot = current_snapshot()
+            if snapshot:
+                position = snapshot.random_position(category_id, previous_questions)
+                current_question = snapshot.format(position) if position is not None else None
             else:
-                current_question = None
+                question = random_question(category_id, previous_questions)
+                current_question = question.format() if question else None
 
             return jsonify({
                 "success": True,
@@ -247,6 +609,94 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    @app.route('/quizzes/deck', methods=["POST"])
+    def deal_quiz_deck():
+        body = request.get_json(silent=True) or {}
+
+        try:
+            category_id = parse_quiz_category(body.get('quiz_category', None))
+            previous_questions = parse_previous_questions(body.get('previous_questions', []))
+            size = int(body.get('size', QUIZ_DECK_SIZE))
+            seed = body.get('seed', None)
+            if seed is not None:
+                seed = int(seed)
+        except Exception:
+            abort(422)
+        if size < 1 or size > MAX_QUIZ_DECK_SIZE or (seed is not None and seed < 0):
+            abort(422)
+
+        try:
+            questions, seed = build_deck(size, category_id, previous_questions, seed)
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            "success": True,
+            "questions": [question.format() for question in questions],
+            "seed": seed
+        })
+
+    """
+    Quiz sessions: the server remembers which questions a quiz run has
+    already played, so clients only send the session id for each question.
+    """
+
+    @app.route('/quizzes/sessions', methods=["POST"])
+    def start_quiz_session():
+        body = request.get_json(silent=True) or {}
+
+        try:
+            category_id = parse_quiz_category(body.get('quiz_category', None))
+        except Exception:
+            abort(422)
+
+        session = quiz_sessions.create(category_id)
+        return jsonify({
+            "success": True,
+            "session_id": session.session_id
+        })
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=["POST"])
+    def next_quiz_question(session_id):
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+
+        with session.lock:
+            try:
+                question = random_question(session.category_id, session)
+            except Exception:
+                abort(422)
+
+            current_question = None
+            if question:
+                session.mark_seen(question.id)
+                quiz_sessions.save(session)
+                current_question = question.format()
+            played = len(session.seen)
+
+        return jsonify({
+            "success": True,
+            "question": current_question,
+            "played": played
+        })
+
+    @app.route('/quizzes/sessions/<session_id>', methods=["DELETE"])
+    def end_quiz_session(session_id):
+        if not quiz_sessions.delete(session_id):
+            abort(404)
+        return jsonify({
+            "success": True,
+            "deleted": session_id
+        })
+
+    @app.route('/health', methods=["GET"])
+    def health():
+        return jsonify({
+            "success": True,
+            "pool": pool_status(app)
+        })
+
     """
     @DONE:
     Create error handlers for all expected errors
@@ -0,0 +1,106 @@
+import json
+import secrets
+import time
+
+from flask.json.provider import DefaultJSONProvider
+
+from timing import add_timing
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+"""
+RawJSON
+    text that is already serialized JSON. FastJSONProvider embeds it in the
+    output verbatim, which lets list endpoints serialize row tuples straight
+    to JSON without building a dict per row first.
+"""
+class RawJSON:
+    __slots__ = ('text', 'length')
+
+    def __init__(self, text, length=0):
+        self.text = text
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+"""
+FastJSONProvider
+    Flask JSON provider that encodes with orjson when it is installed and
+    falls back to the stdlib encoder otherwise (or when the caller passes
+    json.dumps arguments orjson cannot honour, e.g. indentation in debug
+    mode). The compact separators jsonify passes are what orjson writes.
+"""
+COMPACT_SEPARATORS = (',', ':')
+
+
+def orjson_compatible(kwargs):
+    if not kwargs:
+        return True
+    return kwargs.keys() == {'separators'} and tuple(kwargs['separators']) == COMPACT_SEPARATORS
+
+
+class FastJSONProvider(DefaultJSONProvider):
+
+    def encode_string(self, value):
+        if orjson is not None:
+            return orjson.dumps(value).decode()
+        return json.dumps(value, ensure_ascii=self.ensure_ascii)
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        text = self._dumps(obj, **kwargs)
+        add_timing('json', time.perf_counter() - started)
+        return text
+
+    def _dumps(self, obj, **kwargs):
+        # RawJSON values are swapped for unguessable placeholder strings while
+        # encoding, then the encoded placeholders are replaced by the raw text
+        token = secrets.token_hex(8)
+        raw_values = []
+
+        def default(value):
+            if isinstance(value, RawJSON):
+                raw_values.append(value.text)
+                return f'\x00{token}:{len(raw_values) - 1}\x00'
+            return self.default(value)
+
+        if orjson is not None and orjson_compatible(kwargs):
+            options = orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                options |= orjson.OPT_SORT_KEYS
+            text = orjson.dumps(obj, default=default, option=options).decode()
+        else:
+            kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+            kwargs.setdefault('sort_keys', self.sort_keys)
+            text = json.dumps(obj, default=default, **kwargs)
+
+        for index, raw in enumerate(raw_values):
+            text = text.replace(json.dumps(f'\x00{token}:{index}\x00'), raw, 1)
+        return text
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+
+QUESTION_ROW_TEMPLATE = '{"answer":%s,"category":%d,"difficulty":%d,"id":%d,"question":%s}'
+
+
+def question_rows_json(rows, encode_string):
+    """
+    Serializes (id, question, answer, category, difficulty) row tuples to a
+    JSON array of question objects, with the keys in the same (sorted) order
+    as Question.format() output. Extra trailing columns (e.g. a total) are
+    ignored.
+    """
+    items = [
+        QUESTION_ROW_TEMPLATE % (encode_string(answer), category, difficulty, question_id, encode_string(question))
+        for question_id, question, answer, category, difficulty, *_ in rows
+    ]
+    return RawJSON('[' + ','.join(items) + ']', len(items))
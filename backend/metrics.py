@@ -0,0 +1,274 @@
+import glob
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+
+from flask import Response, g, request
+
+from models import pool_status
+from settings import METRICS_DIR
+
+"""
+Prometheus metrics for every route, served as text exposition by
+GET /metrics.
+
+Each thread records into its own shard, behind a lock that only a scrape
+ever contends for; a scrape copies and sums the shards. With METRICS_DIR set
+(a directory shared by the gunicorn workers), every worker also writes its
+totals to METRICS_DIR/metrics-<pid>-<token>.json at most every
+METRICS_FLUSH_INTERVAL seconds, and a scrape of any worker reports the sum
+over all of them. The random token keeps a worker that reuses the pid of an
+exited one from overwriting its counters.
+"""
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_FLUSH_INTERVAL = 5.0
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+"""
+MetricsRegistry
+    per-thread request counters and latency histograms of one worker
+"""
+class MetricsRegistry:
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {'lock': threading.Lock(), 'requests': {}, 'latency': {}}
+            self._local.shard = shard
+            # only taken once per thread
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def observe(self, endpoint, method, status, seconds):
+        shard = self._shard()
+        key = (endpoint, method, str(status))
+        with shard['lock']:
+            shard['requests'][key] = shard['requests'].get(key, 0) + 1
+
+            histogram = shard['latency'].get((endpoint, method))
+            if histogram is None:
+                histogram = shard['latency'][(endpoint, method)] = {
+                    'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0
+                }
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """
+        Totals over all shards, with histogram buckets not yet cumulative.
+        """
+        with self._shards_lock:
+            shards = list(self._shards)
+        snapshots = []
+        for shard in shards:
+            with shard['lock']:
+                snapshots.append({
+                    'requests': dict(shard['requests']),
+                    'latency': {
+                        key: {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+                        for key, value in shard['latency'].items()
+                    },
+                })
+        return merge_snapshots(snapshots)
+
+
+def merge_snapshots(snapshots):
+    merged = {'requests': {}, 'latency': {}}
+    for snapshot in snapshots:
+        for key, count in snapshot['requests'].items():
+            merged['requests'][key] = merged['requests'].get(key, 0) + count
+        for key, value in snapshot['latency'].items():
+            histogram = merged['latency'].setdefault(
+                key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+            )
+            histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], value['buckets'])]
+            histogram['sum'] += value['sum']
+            histogram['count'] += value['count']
+    return merged
+
+
+# pid -> snapshot file name; a forked worker has its own pid, so it never
+# picks up the name of the process it was forked from
+_snapshot_names = {}
+
+
+def snapshot_name():
+    pid = os.getpid()
+    name = _snapshot_names.get(pid)
+    if name is None:
+        name = _snapshot_names[pid] = f'metrics-{pid}-{secrets.token_hex(8)}.json'
+    return name
+
+
+def write_snapshot(directory, snapshot, pool):
+    data = {
+        'pid': os.getpid(),
+        'requests': [[*key, count] for key, count in snapshot['requests'].items()],
+        'latency': [[*key, value] for key, value in snapshot['latency'].items()],
+        'pool': pool,
+    }
+    path = os.path.join(directory, snapshot_name())
+    # a temporary file of its own, so a concurrent writer can never replace
+    # or truncate it; readers only see whole files
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.metrics-', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_snapshots(directory):
+    """
+    All workers' snapshots: counters of exited workers still count, pool
+    gauges only from live ones.
+    """
+    snapshots, pools = [], []
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        snapshots.append({
+            'requests': {tuple(item[:3]): item[3] for item in data['requests']},
+            'latency': {tuple(item[:2]): item[2] for item in data['latency']},
+        })
+        if pid_alive(data['pid']):
+            pools.append(data['pool'])
+    return merge_snapshots(snapshots), pools
+
+
+def label_text(**labels):
+    pairs = ','.join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition(snapshot, pools):
+    lines = [
+        '# HELP trivia_http_requests_total HTTP requests by endpoint, method and status.',
+        '# TYPE trivia_http_requests_total counter',
+    ]
+    for (endpoint, method, status), count in sorted(snapshot['requests'].items()):
+        lines.append(f'trivia_http_requests_total{label_text(endpoint=endpoint, method=method, status=status)} {count}')
+
+    lines += [
+        '# HELP trivia_http_request_errors_total HTTP requests answered with a 4xx or 5xx status.',
+        '# TYPE trivia_http_request_errors_total counter',
+    ]
+    for (endpoint, method, status), count in sorted(snapshot['requests'].items()):
+        if int(status) >= 400:
+            lines.append(f'trivia_http_request_errors_total{label_text(endpoint=endpoint, method=method, status=status)} {count}')
+
+    lines += [
+        '# HELP trivia_http_request_duration_seconds HTTP request latency by endpoint and method.',
+        '# TYPE trivia_http_request_duration_seconds histogram',
+    ]
+    for (endpoint, method), histogram in sorted(snapshot['latency'].items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+            cumulative += count
+            labels = label_text(endpoint=endpoint, method=method, le=format_number(bound))
+            lines.append(f'trivia_http_request_duration_seconds_bucket{labels} {cumulative}')
+        labels = label_text(endpoint=endpoint, method=method, le='+Inf')
+        lines.append(f"trivia_http_request_duration_seconds_bucket{labels} {histogram['count']}")
+        labels = label_text(endpoint=endpoint, method=method)
+        lines.append(f"trivia_http_request_duration_seconds_sum{labels} {format_number(histogram['sum'])}")
+        lines.append(f"trivia_http_request_duration_seconds_count{labels} {histogram['count']}")
+
+    pool_metrics = [
+        ('checked_out', 'gauge', 'Connections currently checked out of the pool.'),
+        ('checked_in', 'gauge', 'Idle connections in the pool.'),
+        ('size', 'gauge', 'Configured pool size.'),
+        ('overflow', 'gauge', 'Connections open beyond the pool size (negative while below it).'),
+        ('connects', 'counter', 'New database connections opened.'),
+        ('checkouts', 'counter', 'Connection checkouts from the pool.'),
+        ('invalidations', 'counter', 'Connections invalidated (e.g. failed pre-ping).'),
+    ]
+    for key, metric_type, help_text in pool_metrics:
+        values = [pool[key] for pool in pools if pool.get(key) is not None]
+        if not values:
+            continue
+        name = f'trivia_db_pool_{key}' + ('_total' if metric_type == 'counter' else '')
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {sum(values)}']
+    return '\n'.join(lines) + '\n'
+
+
+def init_metrics(app):
+    registry = MetricsRegistry()
+    app.extensions['metrics'] = registry
+    directory = app.config.get('METRICS_DIR', METRICS_DIR)
+    flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', METRICS_FLUSH_INTERVAL)
+    last_flush = {'at': 0.0}
+    flush_lock = threading.Lock()
+
+    def flush(wait=False):
+        # one flush at a time; a request finding one under way skips its own
+        if not flush_lock.acquire(blocking=wait):
+            return
+        try:
+            last_flush['at'] = time.monotonic()
+            write_snapshot(directory, registry.snapshot(), pool_status(app))
+        finally:
+            flush_lock.release()
+
+    @app.before_request
+    def start_metrics_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_metrics(response):
+        started = g.get('metrics_started')
+        if started is not None:
+            registry.observe(
+                request.endpoint or 'unmatched', request.method, response.status_code,
+                time.perf_counter() - started
+            )
+        if directory and time.monotonic() - last_flush['at'] >= flush_interval:
+            flush()
+        return response
+
+    @app.route('/metrics', methods=["GET"])
+    def get_metrics():
+        if directory:
+            flush(wait=True)
+            snapshot, pools = read_snapshots(directory)
+        else:
+            snapshot, pools = registry.snapshot(), [pool_status(app)]
+        return Response(exposition(snapshot, pools), content_type=CONTENT_TYPE)
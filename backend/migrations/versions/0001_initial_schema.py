@@ -0,0 +1,46 @@
+"""initial schema: categories and questions
+
+Databases loaded from trivia.psql (or created by db.create_all) already
+have these tables; they are left as they are, so `flask db upgrade` can be
+run on them directly.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-16 09:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+    if 'categories' not in existing:
+        op.create_table(
+            'categories',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('type', sa.String(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'questions' not in existing:
+        op.create_table(
+            'questions',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('question', sa.String(), nullable=False),
+            sa.Column('answer', sa.String(), nullable=False),
+            sa.Column('category', sa.Integer(), nullable=False),
+            sa.Column('difficulty', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('questions')
+    op.drop_table('categories')
@@ -0,0 +1,34 @@
+"""data_version counter behind the list endpoint ETags
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-16 09:05:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'data_version' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'data_version',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    op.execute(
+        'INSERT INTO data_version (id, version) '
+        'SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM data_version WHERE id = 1)'
+    )
+
+
+def downgrade():
+    op.drop_table('data_version')
@@ -0,0 +1,40 @@
+"""full-text search column for POST /questions searches
+
+Adds questions.search_vector, keeps it up to date with a trigger and
+indexes it with GIN. PostgreSQL only; a no-op elsewhere.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-16 09:10:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE questions ADD COLUMN IF NOT EXISTS search_vector tsvector')
+    op.execute("UPDATE questions SET search_vector = to_tsvector('pg_catalog.english', coalesce(question, ''))")
+    op.execute('DROP TRIGGER IF EXISTS questions_search_vector_update ON questions')
+    op.execute("""
+        CREATE TRIGGER questions_search_vector_update
+            BEFORE INSERT OR UPDATE OF question ON questions
+            FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', question)
+    """)
+    op.execute('CREATE INDEX IF NOT EXISTS ix_questions_search_vector ON questions USING GIN (search_vector)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('DROP TRIGGER IF EXISTS questions_search_vector_update ON questions')
+    op.execute('DROP INDEX IF EXISTS ix_questions_search_vector')
+    op.execute('ALTER TABLE questions DROP COLUMN IF EXISTS search_vector')
@@ -0,0 +1,36 @@
+"""pg_trgm index answering substring (ILIKE) searches
+
+Built CONCURRENTLY outside the migration transaction so the table stays
+writable. PostgreSQL only; a no-op elsewhere.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-16 09:15:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        op.execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_questions_question_trgm '
+            'ON questions USING GIN (question gin_trgm_ops)'
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_questions_question_trgm')
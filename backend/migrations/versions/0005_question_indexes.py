@@ -0,0 +1,45 @@
+"""indexes for category listings, category quizzes and difficulty filters
+
+On PostgreSQL the indexes are built CONCURRENTLY, outside the migration
+transaction, so deploying does not lock the questions table. A concurrent
+build that fails leaves an INVALID index behind; drop it and rerun.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-16 09:20:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_questions_category', ['category']),
+    ('ix_questions_difficulty', ['difficulty']),
+    ('ix_questions_category_id', ['category', 'id']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, columns in INDEXES:
+                op.create_index(name, 'questions', columns, postgresql_concurrently=True, if_not_exists=True)
+    else:
+        for name, columns in INDEXES:
+            op.create_index(name, 'questions', columns, if_not_exists=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, _ in INDEXES:
+                op.drop_index(name, table_name='questions', postgresql_concurrently=True, if_exists=True)
+    else:
+        for name, _ in INDEXES:
+            op.drop_index(name, table_name='questions', if_exists=True)
@@ -0,0 +1,45 @@
+"""category_stats counters behind listing totals and category sizes
+
+The table is backfilled from the questions table. From then on the app
+keeps it in step in the same transaction as every question write; rows
+changed outside the app (e.g. by hand in psql) need a rerun of
+backfill().
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-16 09:40:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def backfill():
+    op.execute('DELETE FROM category_stats')
+    op.execute(
+        'INSERT INTO category_stats (category_id, difficulty, question_count) '
+        'SELECT category, difficulty, count(*) FROM questions GROUP BY category, difficulty'
+    )
+
+
+def upgrade():
+    if 'category_stats' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'category_stats',
+            sa.Column('category_id', sa.Integer(), nullable=False),
+            sa.Column('difficulty', sa.Integer(), nullable=False),
+            sa.Column('question_count', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('category_id', 'difficulty')
+        )
+    backfill()
+
+
+def downgrade():
+    op.drop_table('category_stats')
@@ -1,12 +1,90 @@
-from sqlalchemy import Column, String, Integer
+import threading
+import time
+
+from flask import g, has_request_context
+from sqlalchemy import Column, String, Integer, DDL, Index, event, func, inspect, select, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import Session, column_property, object_session
 from flask_sqlalchemy import SQLAlchemy
-from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST
+from query_tracker import track_queries
+from settings import (
+    DB_NAME,
+    DB_USER,
+    DB_PASSWORD,
+    DB_HOST,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_PRE_PING,
+    DB_POOL_RECYCLE,
+    DB_STATEMENT_TIMEOUT,
+    DATABASE_URL,
+    SQLITE_MMAP_SIZE,
+)
 
-database_path = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}'
+database_path = DATABASE_URL or f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}'
 #database_path = f'postgresql://{database_user}:{database_password}@{database_host}/{database_name}'
 
 db = SQLAlchemy()
 
+"""
+engine_options(config, database_path)
+    SQLALCHEMY_ENGINE_OPTIONS built from the DB_POOL_* / DB_STATEMENT_TIMEOUT
+    config keys, falling back to settings.py (i.e. the environment)
+"""
+def engine_options(config, database_path):
+    options = {
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', DB_POOL_PRE_PING),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', DB_POOL_RECYCLE),
+    }
+    # SQLite uses its own single connection / per thread pools
+    if not database_path.startswith('sqlite'):
+        options['pool_size'] = config.get('DB_POOL_SIZE', DB_POOL_SIZE)
+        options['max_overflow'] = config.get('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW)
+        options['pool_timeout'] = config.get('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT)
+
+    statement_timeout = config.get('DB_STATEMENT_TIMEOUT', DB_STATEMENT_TIMEOUT)
+    if statement_timeout and database_path.startswith('postgresql'):
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
+
+"""
+configure_sqlite(engine, config)
+    connection setup of the SQLite backend: WAL journal (readers do not block
+    the writer), synchronous=NORMAL (durable at checkpoints, safe with WAL)
+    and a memory mapped database file of SQLITE_MMAP_SIZE bytes
+"""
+def configure_sqlite(engine, config):
+    mmap_size = int(config.get('SQLITE_MMAP_SIZE', SQLITE_MMAP_SIZE))
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        # pysqlite's own implicit transactions break SAVEPOINT; SQLAlchemy
+        # emits BEGIN itself instead (on_begin)
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA mmap_size={mmap_size}')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+"""
+include_object(...)
+    Alembic autogenerate filter. The search column, trigger and indexes are
+    owned by migrations written by hand (0003, 0004) and are not mapped, so
+    autogenerate must not propose dropping them.
+"""
+UNMAPPED_SCHEMA = {'search_vector', 'ix_questions_search_vector', 'ix_questions_question_trgm'}
+
+def include_object(object, name, type_, reflected, compare_to):
+    return not (reflected and compare_to is None and name in UNMAPPED_SCHEMA)
+
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
@@ -14,19 +92,47 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config['SQLALCHEMY_DATABASE_URI'] = database_path
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config, database_path))
     db.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            configure_sqlite(db.engine, app.config)
+        track_pool(app, db.engine)
+        track_queries(app, db.engine)
+    category_cache.ttl = app.config.get('CATEGORY_CACHE_TTL', CATEGORY_CACHE_TTL)
+    category_cache.invalidate()
+
+"""
+schema_revision()
+    the Alembic revision the database is at, None when it was never migrated
+"""
+def schema_revision():
+    try:
+        return db.session.execute(text('SELECT version_num FROM alembic_version')).scalar()
+    except (OperationalError, ProgrammingError):
+        # alembic_version does not exist yet
+        db.session.rollback()
+        return None
 
 """
 Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    # created by migrations/versions/0005_question_indexes.py
+    __table_args__ = (
+        Index('ix_questions_category', 'category'),
+        Index('ix_questions_difficulty', 'difficulty'),
+        Index('ix_questions_category_id', 'category', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String, nullable=False)
     answer = Column(String, nullable=False)
-    category = Column(Integer, nullable=False)
-    difficulty = Column(Integer, nullable=False)
+    # active_history loads the old value before it is replaced, even on an
+    # expired instance, so count_moved_question always knows what it leaves
+    category = column_property(Column(Integer, nullable=False), active_history=True)
+    difficulty = column_property(Column(Integer, nullable=False), active_history=True)
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -36,13 +142,16 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_data_version()
         db.session.commit()
 
     def update(self):
+        bump_data_version()
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_data_version()
         db.session.commit()
 
     def format(self):
@@ -66,8 +175,318 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        bump_data_version()
+        db.session.commit()
+
+    def update(self):
+        bump_data_version()
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        bump_data_version()
+        db.session.commit()
+
     def format(self):
         return {
             'id': self.id,
             'type': self.type
         }
+
+
+"""
+CategoryCache
+    process-local cache of the category id -> type map in both orderings.
+    Entries expire after `ttl` seconds and are dropped as soon as a session
+    commits a Category write. Each entry also remembers the data version
+    its request read (see conditional_get); a request that read another
+    version reloads it, so writes made by other workers never end up in a
+    body tagged with a version they are not part of.
+"""
+CATEGORY_CACHE_TTL = 300
+
+class CategoryCache:
+
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._entry = None
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entry = None
+
+    def _cached(self):
+        entry = self._entry
+        if entry is None or time.monotonic() - entry['loaded_at'] >= self.ttl:
+            return None
+        version = request_data_version()
+        if version is not None and entry['version'] != version:
+            return None
+        return entry
+
+    def _load(self):
+        generation = self._generation
+        # read before the categories: a write committed in between only makes
+        # the entry look older than it is, which costs another reload
+        version = request_data_version()
+        rows = db.session.query(Category.id, Category.type).order_by(Category.id).all()
+        by_id = {category_id: category_type for category_id, category_type in rows}
+        entry = {
+            'loaded_at': time.monotonic(),
+            'version': version,
+            'by_id': by_id,
+            'by_type': dict(sorted(by_id.items(), key=lambda item: item[1])),
+        }
+        with self._lock:
+            # a write committed while we were loading; serve it but don't keep it
+            if generation == self._generation:
+                self._entry = entry
+        return entry
+
+    def _get(self):
+        return self._cached() or self._load()
+
+    def types_by_id(self):
+        return self._get()['by_id']
+
+    def types_by_type(self):
+        return self._get()['by_type']
+
+    def get_type(self, category_id):
+        """
+        The category's type, None when it does not exist. An id the cache
+        does not know (e.g. created by another worker within the TTL)
+        reloads it, so the lookup runs at most one query either way.
+        """
+        entry = self._cached()
+        if entry is None or category_id not in entry['by_id']:
+            entry = self._load()
+        return entry['by_id'].get(category_id)
+
+
+category_cache = CategoryCache()
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def category_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['categories_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_category_cache(session):
+    if session.info.pop('categories_changed', False):
+        category_cache.invalidate()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_category_changes(session, previous_transaction):
+    session.info.pop('categories_changed', None)
+
+
+
+"""
+DataVersion
+    single row counter bumped in the same transaction as every question or
+    category write. List endpoints derive their ETags from it, so they can
+    answer conditional requests without running the listing queries.
+"""
+class DataVersion(db.Model):
+    __tablename__ = 'data_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+event.listen(
+    DataVersion.__table__,
+    'after_create',
+    DDL('INSERT INTO data_version (id, version) VALUES (1, 0)')
+)
+
+
+def bump_data_version():
+    table = DataVersion.__table__
+    db.session.execute(
+        table.update().where(table.c.id == 1).values(version=table.c.version + 1)
+    )
+
+
+def get_data_version():
+    version = db.session.query(DataVersion.version).filter(DataVersion.id == 1).scalar()
+    return version or 0
+
+
+def request_data_version():
+    """
+    The data version the current request's ETag was built from, None when
+    it has none (or outside requests).
+    """
+    return g.get('data_version') if has_request_context() else None
+
+
+
+"""
+CategoryStat
+    number of questions per (category, difficulty), kept in step with the
+    questions table in the same transaction as every write: ORM writes
+    through the Question mapper events below, bulk imports through
+    adjust_category_stats. Listing totals and category sizes read it
+    instead of counting questions.
+"""
+class CategoryStat(db.Model):
+    __tablename__ = 'category_stats'
+
+    category_id = Column(Integer, primary_key=True)
+    difficulty = Column(Integer, primary_key=True)
+    question_count = Column(Integer, nullable=False, default=0)
+
+
+def adjust_category_stats(connection, deltas):
+    """
+    Adds {(category_id, difficulty): change} to the counters with a single
+    upsert statement.
+    """
+    rows = [
+        {'category_id': category_id, 'difficulty': difficulty, 'question_count': change}
+        for (category_id, difficulty), change in deltas.items() if change
+    ]
+    if not rows:
+        return
+
+    table = CategoryStat.__table__
+    dialect = connection.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        upsert = (postgresql_insert if dialect == 'postgresql' else sqlite_insert)(table)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[table.c.category_id, table.c.difficulty],
+            set_={'question_count': table.c.question_count + upsert.excluded.question_count}
+        )
+        connection.execute(upsert, rows)
+        return
+
+    for row in rows:
+        result = connection.execute(
+            table.update()
+            .where(table.c.category_id == row['category_id'], table.c.difficulty == row['difficulty'])
+            .values(question_count=table.c.question_count + row['question_count'])
+        )
+        if result.rowcount == 0:
+            connection.execute(table.insert(), row)
+
+
+@event.listens_for(Question, 'after_insert')
+def count_inserted_question(mapper, connection, target):
+    adjust_category_stats(connection, {(target.category, target.difficulty): 1})
+
+
+@event.listens_for(Question, 'after_delete')
+def count_deleted_question(mapper, connection, target):
+    adjust_category_stats(connection, {(target.category, target.difficulty): -1})
+
+
+@event.listens_for(Question, 'after_update')
+def count_moved_question(mapper, connection, target):
+    state = inspect(target)
+    category = state.attrs.category.history
+    difficulty = state.attrs.difficulty.history
+    if not (category.deleted or difficulty.deleted):
+        return
+    old = (
+        category.deleted[0] if category.deleted else target.category,
+        difficulty.deleted[0] if difficulty.deleted else target.difficulty,
+    )
+    new = (target.category, target.difficulty)
+    if old != new:
+        adjust_category_stats(connection, {old: -1, new: 1})
+
+
+def category_stats_total(category_id=None):
+    """
+    SELECT of the number of questions, in one category or in all of them.
+    """
+    statement = select(func.coalesce(func.sum(CategoryStat.question_count), 0))
+    if category_id is not None:
+        statement = statement.where(CategoryStat.category_id == category_id)
+    return statement
+
+
+def category_question_counts():
+    """
+    {category_id: {'total': n, 'by_difficulty': {difficulty: n}}} of the
+    categories that have questions.
+    """
+    counts = {}
+    rows = db.session.query(CategoryStat.category_id, CategoryStat.difficulty, CategoryStat.question_count).filter(
+        CategoryStat.question_count > 0
+    ).order_by(CategoryStat.category_id, CategoryStat.difficulty)
+    for category_id, difficulty, question_count in rows:
+        entry = counts.setdefault(category_id, {'total': 0, 'by_difficulty': {}})
+        entry['total'] += question_count
+        entry['by_difficulty'][difficulty] = question_count
+    return counts
+
+
+"""
+PoolCounters
+    pool event counts; the events fire on every request thread, so each
+    increment is a read-modify-write taken under a lock
+"""
+class PoolCounters:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'connects': 0, 'checkouts': 0, 'invalidations': 0}
+
+    def increment(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+"""
+track_pool(app, engine)
+    counts pool connects, checkouts and invalidations for pool_status
+"""
+def track_pool(app, engine):
+    counters = PoolCounters()
+    app.extensions['pool_counters'] = counters
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        counters.increment('connects')
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        counters.increment('checkouts')
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        counters.increment('invalidations')
+
+
+def pool_status(app):
+    """
+    Snapshot of the connection pool for monitoring. Size and overflow are
+    only reported by queue pools (i.e. not SQLite).
+    """
+    with app.app_context():
+        pool = db.engine.pool
+    counters = app.extensions.get('pool_counters')
+    status = counters.snapshot() if counters is not None else {}
+    status['checked_out'] = pool.checkedout() if hasattr(pool, 'checkedout') else None
+    status['checked_in'] = pool.checkedin() if hasattr(pool, 'checkedin') else None
+    status['size'] = pool.size() if hasattr(pool, 'size') else None
+    status['overflow'] = pool.overflow() if hasattr(pool, 'overflow') else None
+    return status
@@ -0,0 +1,117 @@
+import functools
+import logging
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+"""
+Per-request SQL statement tracking, attached to the engine by setup_db.
+
+Every statement run while handling a request is counted and timed; the
+slowest one is logged when the request ends (at WARNING when it took longer
+than SLOW_QUERY_THRESHOLD seconds, at DEBUG otherwise). Views declare the
+number of statements they may run with @query_budget(n): going over it
+raises QueryBudgetExceeded in testing mode and logs a warning otherwise,
+which catches N+1 patterns and accidental full-table loads.
+"""
+SLOW_QUERY_THRESHOLD = 0.5
+# not counted: transaction control (the SQLite backend's explicit BEGIN, the
+# test suite's per-test SAVEPOINTs) is not work the view asked for
+TRANSACTION_CONTROL = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+"""
+QueryStats
+    statements run by one request
+"""
+class QueryStats:
+    __slots__ = ('count', 'seconds', 'slowest', 'slowest_seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = None
+        self.slowest_seconds = 0.0
+
+
+def request_query_stats():
+    """
+    The QueryStats of the current request, None outside requests.
+    """
+    if not has_request_context():
+        return None
+    stats = g.get('query_stats')
+    if stats is None:
+        stats = g.query_stats = QueryStats()
+    return stats
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the execution context rather than the connection: a statement
+    # that raises never reaches after_cursor_execute, and its start time is
+    # dropped with its context instead of lingering for the next statement
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if started is None or statement.startswith(TRANSACTION_CONTROL):
+        return
+    seconds = time.perf_counter() - started
+    stats = request_query_stats()
+    if stats is None:
+        return
+    stats.count += 1
+    stats.seconds += seconds
+    if seconds >= stats.slowest_seconds:
+        stats.slowest = statement
+        stats.slowest_seconds = seconds
+
+
+def track_queries(app, engine):
+    app.extensions['query_tracker'] = {'last_request': None}
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    @app.after_request
+    def log_slowest_query(response):
+        stats = g.get('query_stats')
+        app.extensions['query_tracker']['last_request'] = stats
+        if stats is None:
+            return response
+        threshold = app.config.get('SLOW_QUERY_THRESHOLD', SLOW_QUERY_THRESHOLD)
+        level = logging.WARNING if stats.slowest_seconds >= threshold else logging.DEBUG
+        logger.log(
+            level, '%s (%s): %d queries in %.2f ms, slowest %.2f ms: %s',
+            request.endpoint, response.status_code, stats.count,
+            stats.seconds * 1000, stats.slowest_seconds * 1000, stats.slowest
+        )
+        return response
+
+
+def query_budget(limit):
+    """
+    Declares the most statements a view may run (put it outside decorators
+    that run queries themselves, e.g. conditional_get).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            response = view(*args, **kwargs)
+            stats = g.get('query_stats')
+            if stats is not None and stats.count > limit:
+                message = f'{view.__name__} ran {stats.count} queries, over its budget of {limit}'
+                if current_app.testing:
+                    raise QueryBudgetExceeded(message)
+                logger.warning(message)
+            return response
+        return wrapper
+    return decorator
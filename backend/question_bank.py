@@ -0,0 +1,212 @@
+import bisect
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import weakref
+from array import array
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import Session
+
+from models import Category, Question, db, get_data_version
+from settings import IN_MEMORY_BANK
+
+"""
+Read-only in-memory serving of the question bank, switched on with the
+IN_MEMORY_BANK config key.
+
+create_app loads every question and category into a column-oriented
+QuestionBankSnapshot: ids, categories and difficulties in array('i'),
+question and answer text interned. GET /categories, GET /questions,
+GET /categories/<id>/questions, search and POST /quizzes then read the
+snapshot instead of the database. Writes still go to the database; the
+snapshot is rebuilt, and swapped in whole, once the data version moved.
+The version is checked after every commit in this process, and at most
+every BANK_REFRESH_INTERVAL seconds for writes made by other processes.
+"""
+BANK_REFRESH_INTERVAL = 2.0
+# random picks tried before /quizzes filters the remaining candidates
+QUIZ_SAMPLE_TRIES = 8
+EMPTY_POSITIONS = array('i')
+WORD = re.compile(r'\w+')
+
+
+"""
+QuestionBankSnapshot
+    every question and category at one data version. Questions are stored
+    in id order; a "position" is an index into the column arrays.
+"""
+class QuestionBankSnapshot:
+
+    def __init__(self, version, rows, categories):
+        self.version = version
+        self.ids = array('i')
+        self.categories = array('i')
+        self.difficulties = array('i')
+        self.questions = []
+        self.answers = []
+        self.search_text = []
+        by_category = {}
+        for position, (question_id, question, answer, category, difficulty) in enumerate(rows):
+            self.ids.append(question_id)
+            self.categories.append(category)
+            self.difficulties.append(difficulty)
+            self.questions.append(sys.intern(question))
+            self.answers.append(sys.intern(answer))
+            self.search_text.append(question.lower())
+            by_category.setdefault(category, array('i')).append(position)
+        self.by_category = by_category
+
+        self.category_types = {category_id: sys.intern(category_type) for category_id, category_type in categories}
+        self.category_types_by_type = dict(sorted(self.category_types.items(), key=lambda item: item[1]))
+        self.counts = {}
+        for category_id, positions in by_category.items():
+            by_difficulty = {}
+            for position in positions:
+                difficulty = self.difficulties[position]
+                by_difficulty[difficulty] = by_difficulty.get(difficulty, 0) + 1
+            self.counts[category_id] = {'total': len(positions), 'by_difficulty': dict(sorted(by_difficulty.items()))}
+
+    def positions(self, category_id=None):
+        if category_id is None:
+            return range(len(self.ids))
+        return self.by_category.get(category_id, EMPTY_POSITIONS)
+
+    def seek(self, positions, last_id):
+        """
+        Index into `positions` of the first question with an id above last_id.
+        """
+        return bisect.bisect_left(positions, bisect.bisect_right(self.ids, last_id))
+
+    def rows(self, positions):
+        return [
+            (self.ids[position], self.questions[position], self.answers[position],
+             self.categories[position], self.difficulties[position])
+            for position in positions
+        ]
+
+    def format(self, position):
+        return {
+            'id': self.ids[position],
+            'question': self.questions[position],
+            'answer': self.answers[position],
+            'category': self.categories[position],
+            'difficulty': self.difficulties[position],
+        }
+
+    def search(self, search_term, mode=None):
+        """
+        Positions of the matching questions, in id order. `fulltext` matches
+        questions holding a word starting with each word of the term (like
+        the prefix tsquery, without stemming); `substring` and `auto` match
+        the term anywhere in the question, ignoring case.
+        """
+        if not search_term:
+            return self.positions()
+        if mode == 'fulltext':
+            patterns = [re.compile(r'\b' + re.escape(word)) for word in WORD.findall(search_term.lower())]
+            if not patterns:
+                return []
+            return [
+                position for position, text in enumerate(self.search_text)
+                if all(pattern.search(text) for pattern in patterns)
+            ]
+        needle = search_term.lower()
+        return [position for position, text in enumerate(self.search_text) if needle in text]
+
+    def random_position(self, category_id=None, exclude_ids=()):
+        """
+        A random question of the category that is not excluded, None when
+        every candidate has been excluded.
+        """
+        positions = self.positions(category_id)
+        if not positions:
+            return None
+        excluded = set(exclude_ids)
+        for _ in range(QUIZ_SAMPLE_TRIES):
+            position = positions[random.randrange(len(positions))]
+            if self.ids[position] not in excluded:
+                return position
+        remaining = [position for position in positions if self.ids[position] not in excluded]
+        return random.choice(remaining) if remaining else None
+
+
+def load_snapshot(version=None):
+    # the version is read first: rows committed meanwhile only make the
+    # snapshot look older than it is, which triggers another rebuild
+    if version is None:
+        version = get_data_version()
+    rows = db.session.query(
+        Question.id, Question.question, Question.answer, Question.category, Question.difficulty
+    ).order_by(Question.id).all()
+    categories = db.session.query(Category.id, Category.type).order_by(Category.id).all()
+    return QuestionBankSnapshot(version, rows, categories)
+
+
+"""
+QuestionBank
+    the current snapshot of one app, rebuilt when the data version moves
+"""
+class QuestionBank:
+
+    def __init__(self, refresh_interval=BANK_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._build_lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._stale = False
+
+    def load(self):
+        with self._build_lock:
+            self._snapshot = load_snapshot()
+        self._checked_at = time.monotonic()
+
+    def mark_stale(self):
+        self._stale = True
+
+    def current(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.load()
+            return self._snapshot
+        now = time.monotonic()
+        if self._stale or now - self._checked_at >= self.refresh_interval:
+            self._stale = False
+            self._checked_at = now
+            version = get_data_version()
+            if version != snapshot.version and self._build_lock.acquire(blocking=False):
+                # one thread rebuilds; the others keep serving the old snapshot
+                try:
+                    snapshot = self._snapshot = load_snapshot(version)
+                finally:
+                    self._build_lock.release()
+        return snapshot
+
+
+_banks = weakref.WeakSet()
+
+
+@event.listens_for(Session, 'after_commit')
+def mark_banks_stale(session):
+    for bank in list(_banks):
+        bank.mark_stale()
+
+
+def init_question_bank(app):
+    if not app.config.get('IN_MEMORY_BANK', IN_MEMORY_BANK):
+        return None
+    bank = QuestionBank(app.config.get('BANK_REFRESH_INTERVAL', BANK_REFRESH_INTERVAL))
+    with app.app_context():
+        try:
+            bank.load()
+        except (OperationalError, ProgrammingError):
+            # e.g. `flask db upgrade` on an empty database; load on first use
+            db.session.rollback()
+            logging.getLogger(__name__).warning('question bank not loaded at startup', exc_info=True)
+    _banks.add(bank)
+    app.extensions['question_bank'] = bank
+    return bank
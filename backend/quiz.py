@@ -0,0 +1,211 @@
+import bisect
+import functools
+import random
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from sqlalchemy import BigInteger, bindparam, cast, literal, select, union_all
+
+from models import Question, category_stats_total, db
+
+
+def parse_quiz_category(quiz_category):
+    """
+    Returns the category id of a quiz_category payload, or None for "ALL"
+    (a missing category or id 0). The frontend sends ids as strings.
+    """
+    if not quiz_category:
+        return None
+    category_id = int(quiz_category['id'])
+    return category_id or None
+
+
+def parse_previous_questions(previous_questions):
+    if not isinstance(previous_questions, list):
+        raise ValueError('previous_questions must be a list of ids')
+    return [int(question_id) for question_id in previous_questions]
+
+
+def quiz_selection(category_id=None, exclude_ids=()):
+    selection = Question.query
+    if category_id is not None:
+        selection = selection.filter(Question.category == category_id)
+    if exclude_ids:
+        selection = selection.filter(Question.id.notin_(exclude_ids))
+    return selection
+
+
+# random positions drawn per /quizzes call before falling back to the candidate ids
+QUIZ_SAMPLE_SIZE = 8
+
+
+@functools.lru_cache(maxsize=None)
+def sample_statement(by_category):
+    """
+    UNION ALL of QUIZ_SAMPLE_SIZE single row OFFSET lookups in id order,
+    numbered by draw. Built once; the offsets and the category are bound
+    on every call.
+    """
+    ordered = select(Question.id).order_by(Question.id)
+    if by_category:
+        ordered = ordered.where(Question.category == bindparam('category_id'))
+    draws = [
+        select(literal(number).label('draw'), ordered.offset(bindparam(f'offset_{number}')).limit(1).subquery().c.id)
+        for number in range(QUIZ_SAMPLE_SIZE)
+    ]
+    return union_all(*draws).order_by('draw')
+
+
+def random_question(category_id=None, exclude_ids=()):
+    """
+    Picks a random question, every remaining candidate with the same
+    probability, without loading the candidates. The number of questions
+    comes from category_stats; QUIZ_SAMPLE_SIZE random positions below it
+    are looked up in one statement (each an OFFSET walk of the (category,
+    id) index) and the first one that was not excluded is served. Only
+    when every draw was excluded, i.e. late in a run, are the candidate
+    ids loaded to choose among them.
+    `exclude_ids` is a list or any container of ids (e.g. a QuizSession);
+    it is only checked in Python, never bound into the query.
+    Returns None when every candidate has been excluded.
+    """
+    excluded = frozenset(exclude_ids) if isinstance(exclude_ids, (list, tuple)) else exclude_ids
+    selection = quiz_selection(category_id)
+    count = db.session.execute(category_stats_total(category_id)).scalar()
+    if not count:
+        return None
+
+    parameters = {f'offset_{number}': random.randrange(count) for number in range(QUIZ_SAMPLE_SIZE)}
+    if category_id is not None:
+        parameters['category_id'] = category_id
+    for _, question_id in db.session.execute(sample_statement(category_id is not None), parameters):
+        if question_id not in excluded:
+            return db.session.get(Question, question_id)
+
+    ordered = selection.with_entities(Question.id).order_by(Question.id)
+    remaining = [question_id for (question_id,) in ordered if question_id not in excluded]
+    if not remaining:
+        return None
+    return db.session.get(Question, random.choice(remaining))
+
+
+QUIZ_DECK_SIZE = 5
+MAX_QUIZ_DECK_SIZE = 50
+# two different primes below 2**31: keys and multipliers stay under 2**31,
+# so every product fits in a 64 bit integer on every database
+DECK_SHUFFLE_PRIMES = (2147483647, 2147483629)
+
+
+def deck_shuffle_key(seed):
+    """
+    SQL expression ordering questions in a pseudo-random permutation picked
+    by the seed: two rounds of (key * a + b) mod p, with a and b drawn from
+    the seed and a different prime per round.
+    """
+    rng = random.Random(seed)
+    key = cast(Question.id, BigInteger)
+    for prime in DECK_SHUFFLE_PRIMES:
+        key = (key * rng.randrange(1, prime) + rng.randrange(prime)) % prime
+    return key
+
+
+def build_deck(size, category_id=None, exclude_ids=(), seed=None):
+    """
+    Deals `size` distinct questions in one query, shuffled by a keyed hash
+    of the id. The same seed deals the same deck for an unchanged bank.
+    Returns the questions and the seed used (a random one when not given).
+    """
+    if seed is None:
+        seed = random.randrange(DECK_SHUFFLE_PRIMES[0])
+    shuffle_key = deck_shuffle_key(seed)
+    selection = quiz_selection(category_id, exclude_ids)
+    questions = selection.order_by(shuffle_key, Question.id).limit(size).all()
+    return questions, seed
+
+
+"""
+QuizSession
+    server-side state of one quiz run: the category being played and the
+    ids of the questions already served, kept sorted in a compact array('i')
+    (4 bytes per id) instead of being resent by the client on every call.
+    `lock` serialises the calls of one session, so concurrent /next calls
+    never serve the same question twice.
+"""
+class QuizSession:
+
+    def __init__(self, session_id, category_id=None, seen=()):
+        self.session_id = session_id
+        self.category_id = category_id
+        self.seen = array('i', sorted(seen))
+        self.lock = threading.Lock()
+
+    def __contains__(self, question_id):
+        position = bisect.bisect_left(self.seen, question_id)
+        return position < len(self.seen) and self.seen[position] == question_id
+
+    def mark_seen(self, question_id):
+        position = bisect.bisect_left(self.seen, question_id)
+        if position == len(self.seen) or self.seen[position] != question_id:
+            self.seen.insert(position, question_id)
+
+
+"""
+MemoryQuizSessionStore
+    default quiz session backend, local to the process. Sessions expire
+    `ttl` seconds after their last use and the least recently used ones are
+    evicted beyond `max_sessions`.
+
+    Another backend (e.g. shared by several workers) can be configured with
+    QUIZ_SESSION_STORE; it only needs the same create/get/save/delete methods.
+"""
+QUIZ_SESSION_TTL = 3600
+QUIZ_MAX_SESSIONS = 100000
+
+class MemoryQuizSessionStore:
+
+    def __init__(self, ttl=QUIZ_SESSION_TTL, max_sessions=QUIZ_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        # session_id -> (last used, session), least recently used first
+        self._sessions = OrderedDict()
+
+    def _evict(self, now):
+        while self._sessions:
+            session_id, (last_used, _) = next(iter(self._sessions.items()))
+            if now - last_used < self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def create(self, category_id=None):
+        session = QuizSession(secrets.token_urlsafe(16), category_id)
+        self.save(session)
+        return session
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (now, entry[1])
+            self._sessions.move_to_end(session_id)
+            return entry[1]
+
+    def save(self, session):
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session.session_id] = (now, session)
+            self._sessions.move_to_end(session.session_id)
+            self._evict(now)
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,116 @@
+import re
+
+from flask import current_app
+from sqlalchemy import false, func, inspect, literal_column, text
+
+from models import Question, db
+
+"""
+Search modes for the searchTerm branch of POST /questions
+
+    fulltext  - matches the GIN indexed questions.search_vector column
+                (see migrations/versions/0003_question_search_vector.py) and orders
+                by ts_rank. PostgreSQL only.
+    substring - case-insensitive ILIKE '%term%' ordered by id. Works on
+                every database, and is what the frontend originally asked for.
+                When a pg_trgm index covers questions.question (see
+                migrations/versions/0004_question_trigram_index.py) the ILIKE is
+                answered from that index and results are ordered by
+                similarity instead.
+    auto      - fulltext when the search_vector column exists, substring
+                otherwise (SQLite, test databases, unmigrated databases).
+"""
+SEARCH_MODES = ('auto', 'fulltext', 'substring')
+SEARCH_MODE = 'auto'
+SEARCH_CONFIG = 'english'
+# pg_trgm can only use its index once the pattern holds a whole trigram
+TRIGRAM_MIN_LENGTH = 3
+
+TRIGRAM_INDEX_QUERY = text("""
+    SELECT EXISTS (
+        SELECT 1
+        FROM pg_index i
+        JOIN pg_opclass o ON o.oid = ANY(i.indclass::oid[])
+        WHERE i.indrelid = 'questions'::regclass
+          AND o.opcname IN ('gin_trgm_ops', 'gist_trgm_ops')
+    )
+""")
+
+
+def detect_search_features():
+    """
+    Inspects the questions table once per app and remembers which search
+    indexes are available. Runs on the first search, not at startup.
+    """
+    features = current_app.extensions.get('search_features')
+    if features is None:
+        features = {'fulltext': False, 'trigram': False}
+        if db.engine.dialect.name == 'postgresql':
+            columns = {column['name'] for column in inspect(db.engine).get_columns('questions')}
+            features['fulltext'] = 'search_vector' in columns
+            with db.engine.connect() as connection:
+                features['trigram'] = bool(connection.execute(TRIGRAM_INDEX_QUERY).scalar())
+        current_app.extensions['search_features'] = features
+    return features
+
+
+def resolve_search_mode(mode=None):
+    mode = mode or current_app.config.get('SEARCH_MODE', SEARCH_MODE)
+    if mode not in SEARCH_MODES:
+        raise ValueError(f'unknown search mode {mode!r}')
+    features = detect_search_features()
+    if mode == 'auto':
+        return 'fulltext' if features['fulltext'] else 'substring'
+    if mode == 'fulltext' and not features['fulltext']:
+        # asked for explicitly but not available here; degrade instead of failing
+        return 'substring'
+    return mode
+
+
+def prefix_tsquery(search_term):
+    """
+    Turns free text into a to_tsquery expression where every word is a
+    prefix match, so partially typed words still find results.
+    """
+    words = re.findall(r'\w+', search_term)
+    return ' & '.join(f'{word}:*' for word in words)
+
+
+def fulltext_search(search_term):
+    if not search_term:
+        return Question.query.order_by(Question.id)
+    tsquery_text = prefix_tsquery(search_term)
+    if not tsquery_text:
+        # no words to match (e.g. "?" or "--"): match nothing rather than
+        # every question; only an empty term lists the whole bank
+        return Question.query.filter(false()).order_by(Question.id)
+
+    search_vector = literal_column('questions.search_vector')
+    tsquery = func.to_tsquery(SEARCH_CONFIG, tsquery_text)
+    return Question.query.filter(search_vector.op('@@')(tsquery)).order_by(
+        func.ts_rank(search_vector, tsquery).desc(), Question.id
+    )
+
+
+def escape_like(search_term):
+    return search_term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def substring_search(search_term):
+    search_pattern = f'%{escape_like(search_term)}%'
+    selection = Question.query.filter(Question.question.ilike(search_pattern, escape='\\'))
+    if detect_search_features()['trigram'] and len(search_term) >= TRIGRAM_MIN_LENGTH:
+        # the bare column ILIKE is what the gin_trgm_ops index can answer;
+        # ranking by similarity keeps the planner on it rather than walking
+        # the primary key in id order and filtering
+        return selection.order_by(func.similarity(Question.question, search_term).desc(), Question.id)
+    return selection.order_by(Question.id)
+
+
+def search_questions(search_term, mode=None):
+    """
+    Returns an ordered (not yet paginated) Question query for the search term.
+    """
+    if resolve_search_mode(mode) == 'fulltext':
+        return fulltext_search(search_term)
+    return substring_search(search_term)
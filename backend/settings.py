@@ -5,4 +5,32 @@ load_dotenv()
 DB_NAME = os.environ.get("DB_NAME") 
 DB_USER = os.environ.get("DB_USER") 
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
-DB_HOST = os.environ.get("DB_HOST")
\ No newline at end of file
+DB_HOST = os.environ.get("DB_HOST")
+
+# connection pool, see models.engine_options
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_STATEMENT_TIMEOUT = int(os.environ.get("DB_STATEMENT_TIMEOUT", 0))
+
+# boot time schema revision check: off, warn or error
+SCHEMA_CHECK = os.environ.get("SCHEMA_CHECK", "off")
+
+# per-request timing: Server-Timing header and GET /timings
+TIMING_ENABLED = os.environ.get("TIMING_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Prometheus metrics: directory shared by the gunicorn workers, unset for
+# single-process aggregation
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+
+# full SQLAlchemy URL, e.g. sqlite:////var/lib/trivia/trivia.db; overrides DB_*
+DATABASE_URL = os.environ.get("DATABASE_URL") or None
+# test_flaskr.py: defaults to Postgres when DB_USER/DB_HOST are set, SQLite otherwise
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL") or None
+# SQLite: bytes of the database file to memory map (PRAGMA mmap_size)
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+
+# serve GET listings, search and quizzes from an in-process snapshot
+IN_MEMORY_BANK = os.environ.get("IN_MEMORY_BANK", "false").lower() in ("1", "true", "yes")
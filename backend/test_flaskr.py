@@ -1,20 +1,95 @@
+import base64
+import gzip
 import os
+import random
+import shutil
+import tempfile
+import threading
 import unittest
+from collections import Counter
+from unittest import mock
+from flask import jsonify
+from sqlalchemy import create_engine, event, insert, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+import json_provider
 from flaskr import create_app
-from models import db, Question, Category
-from settings import DB_USER, DB_PASSWORD, DB_HOST
+from metrics import MetricsRegistry, read_snapshots, write_snapshot
+from models import db, Question, Category, PoolCounters, bump_data_version, category_cache
+from quiz import random_question
+from search import fulltext_search
+from query_tracker import query_budget, request_query_stats, QueryBudgetExceeded
+from settings import DB_USER, DB_PASSWORD, DB_HOST, TEST_DATABASE_URL
 import json
 
+# one database per pytest-xdist worker, so the suite can run with -n
+XDIST_WORKER = os.environ.get("PYTEST_XDIST_WORKER")
+DATABASE_SUFFIX = f"_{XDIST_WORKER}" if XDIST_WORKER else ""
+
+
+def resolve_test_database_url():
+    """TEST_DATABASE_URL, else Postgres when credentials are set, else a SQLite file"""
+    if TEST_DATABASE_URL:
+        url = make_url(TEST_DATABASE_URL)
+    elif DB_USER and DB_HOST:
+        url = make_url(f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/trivia_test")
+    else:
+        url = make_url(f"sqlite:///{os.path.join(tempfile.gettempdir(), 'trivia_test.db')}")
+
+    if url.get_backend_name() == "sqlite":
+        root, extension = os.path.splitext(url.database)
+        url = url.set(database=f"{root}{DATABASE_SUFFIX}{extension}")
+    else:
+        url = url.set(database=f"{url.database}{DATABASE_SUFFIX}")
+    return url.render_as_string(hide_password=False)
+
+
+TEST_DATABASE_PATH = resolve_test_database_url()
+
+
+def create_test_database():
+    """Create this worker's Postgres database when it does not exist yet"""
+    url = make_url(TEST_DATABASE_PATH)
+    engine = create_engine(url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    with engine.connect() as connection:
+        exists = connection.execute(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": url.database}
+        ).scalar()
+        if not exists:
+            connection.execute(text(f'CREATE DATABASE "{url.database}"'))
+    engine.dispose()
+
+
+def setUpModule():
+    """Create the schema once; each test runs in a transaction that is rolled back"""
+    postgres = TEST_DATABASE_PATH.startswith("postgresql")
+    if postgres:
+        create_test_database()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": TEST_DATABASE_PATH, "TESTING": True})
+    with app.app_context():
+        if postgres:
+            with db.engine.begin() as connection:
+                # also clears tables loaded from trivia.psql, which carry constraints models.py does not know about
+                connection.execute(text('DROP TABLE IF EXISTS questions CASCADE'))
+                connection.execute(text('DROP TABLE IF EXISTS categories CASCADE'))
+        db.drop_all()
+        db.create_all()
+        db.engine.dispose()
+
+
+def tearDownModule():
+    app = create_app({"SQLALCHEMY_DATABASE_URI": TEST_DATABASE_PATH, "TESTING": True})
+    with app.app_context():
+        db.drop_all()
+        db.engine.dispose()
+
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.database_name = "trivia_test"
-        
-        self.database_path = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{self.database_name}"
-        #self.database_path = f"postgresql://{self.database_user}:{self.database_password}@{self.database_host}/{self.database_name}"
+        """Define test variables, initialize app and open the test transaction."""
+        self.database_path = TEST_DATABASE_PATH
 
         # Create app with the test configuration
         self.app = create_app({
@@ -24,27 +99,53 @@ class TriviaTestCase(unittest.TestCase):
         })
         self.client = self.app.test_client()
 
-        # Bind the app to the current context and create all tables
+        # Every session of the test (including the ones of requests) joins this
+        # transaction; their commits only release a SAVEPOINT, and tearDown
+        # rolls everything back.
         with self.app.app_context():
-            db.create_all()
-            science = Category(type='Science')
-            art = Category(type='Art')
-            db.session.add_all([science, art])
-            db.session.commit()
-            q1 = Question(question='Test question 1', answer='Test answer 1',
-                           category=art.id, difficulty=1)
-            q2 = Question(question='Test question 2', answer='Test answer 2',
-                           category=science.id, difficulty=2)
-            q1.insert()
-            q2.insert()
+            self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.app_session = db.session
+        db.session = scoped_session(sessionmaker(
+            bind=self.connection,
+            join_transaction_mode="create_savepoint",
+            query_cls=db.Query
+        ))
+        # the category cache is process wide and would keep rolled back rows
+        category_cache.invalidate()
+
+        self.science_id = self.create_category('Science')
+        self.art_id = self.create_category('Art')
+        self.create_question('Test question 1', category=self.art_id, difficulty=1)
+        self.create_question('Test question 2', category=self.science_id, difficulty=2)
 
     def tearDown(self):
-        """Executed after each test"""
+        """Roll back everything the test wrote"""
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+        with self.app.app_context():
+            db.engine.dispose()
+
+    def create_category(self, type):
+        """Factory: insert a category and return its id"""
+        with self.app.app_context():
+            category = Category(type=type)
+            category.insert()
+            return category.id
+
+    def create_question(self, question, answer='Test answer', category=None, difficulty=1):
+        """Factory: insert a question (in the Science category by default) and return its id"""
         with self.app.app_context():
-            db.session.remove()
-            db.engine.execute('DROP TABLE IF EXISTS questions CASCADE')
-            db.engine.execute('DROP TABLE IF EXISTS categories CASCADE')
-            db.drop_all()
+            row = Question(
+                question=question,
+                answer=answer,
+                category=category if category is not None else self.science_id,
+                difficulty=difficulty
+            )
+            row.insert()
+            return row.id
 
     """
     DONE
@@ -71,6 +172,71 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "resource not found")
 
+    def test_get_questions_serializes_like_format(self):
+        """TEST GET /questions row fast path matches Question.format()"""
+        res = self.client.get('/questions')
+        data = json.loads(res.data)
+        with self.app.app_context():
+            expected = [question.format() for question in Question.query.order_by(Question.id).all()]
+
+        self.assertEqual(data['questions'], expected)
+
+    @unittest.skipIf(json_provider.orjson is None, "orjson is not installed")
+    def test_responses_encoded_with_orjson(self):
+        """TEST jsonify responses take the orjson path of the JSON provider"""
+        with mock.patch.object(json_provider.orjson, 'dumps', wraps=json_provider.orjson.dumps) as dumps:
+            res = self.client.get('/categories')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(dumps.called)
+
+    def test_get_questions_page_size(self):
+        """TEST GET /questions pages in the database and reports the full total"""
+        res = self.client.get('/questions?page=2&questions_per_page=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions']), 1)
+        self.assertEqual(data['questions'][0]['question'], 'Test question 2')
+        self.assertEqual(data['total_questions'], 2)
+
+    def test_400_sent_requesting_invalid_page_size(self):
+        """TEST GET /questions rejects out of range page sizes"""
+        res = self.client.get('/questions?questions_per_page=1000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_questions_cursor_mode(self):
+        """TEST GET /questions walks the bank with after/next_cursor"""
+        res = self.client.get('/questions?after=&questions_per_page=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'][0]['question'], 'Test question 1')
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client.get(f"/questions?after={data['next_cursor']}&questions_per_page=1")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'][0]['question'], 'Test question 2')
+        self.assertEqual(data['next_cursor'], None)
+
+    def test_400_sent_for_malformed_cursor(self):
+        """TEST GET /questions rejects a malformed after token"""
+        res = self.client.get('/questions?after=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+        cursor = base64.urlsafe_b64encode(b'{"id": true}').decode().rstrip('=')
+        res = self.client.get(f'/questions?after={cursor}')
+
+        self.assertEqual(res.status_code, 400)
+
     def test_delete_question(self):
         """TEST DELETE for /questions/id endpoint"""
         with self.app.app_context():
@@ -104,12 +270,115 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['categories']))
 
+    def test_get_categories_sees_new_category(self):
+        """TEST GET /categories drops its cached categories after a Category write"""
+        self.client.get('/categories')
+        with self.app.app_context():
+            Category(type='Sports').insert()
+
+        res = self.client.get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Sports', data['categories'].values())
+
+    def test_get_categories_sees_category_from_another_worker(self):
+        """TEST GET /categories never tags the new data version with cached categories"""
+        self.client.get('/categories')
+        with self.app.app_context():
+            # a Core insert, like a write from another worker, leaves the cache as it is
+            db.session.execute(insert(Category).values(type='Sports'))
+            bump_data_version()
+            db.session.commit()
+
+        res = self.client.get('/categories')
+        etag = res.headers['ETag']
+
+        self.assertIn('Sports', json.loads(res.data)['categories'].values())
+        res = self.client.get('/categories', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_categories_not_modified(self):
+        """TEST GET /categories answers 304 until the data version changes"""
+        res = self.client.get('/categories')
+        etag = res.headers['ETag']
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+
+        res = self.client.get('/categories', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        with self.app.app_context():
+            Question(question='Q', answer='A', category=self.science_id, difficulty=1).insert()
+
+        res = self.client.get('/questions', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_categories_with_counts(self):
+        """TEST GET /categories?with_counts=1 reports questions per category and difficulty"""
+        empty_id = self.create_category('History')
+        res = self.client.get('/categories?with_counts=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['counts'][str(self.art_id)], {'total': 1, 'by_difficulty': {'1': 1}})
+        self.assertEqual(data['counts'][str(empty_id)]['total'], 0)
+        self.assertNotIn('counts', json.loads(self.client.get('/categories').data))
+
+    def test_category_stats_follow_question_writes(self):
+        """TEST listing totals stay correct through insert, update, delete and bulk import"""
+        question_id = self.create_question('Moving question', category=self.science_id, difficulty=3)
+        with self.app.app_context():
+            question = db.session.get(Question, question_id)
+            question.category = self.art_id
+            question.update()
+        self.client.post('/questions/bulk', json=[
+            {"question": "Bulk", "answer": "A", "category": self.art_id, "difficulty": 3}
+        ])
+        self.client.delete(f'/questions/{question_id}')
+
+        counts = json.loads(self.client.get('/categories?with_counts=1').data)['counts']
+        self.assertEqual(counts[str(self.art_id)], {'total': 2, 'by_difficulty': {'1': 1, '3': 1}})
+        self.assertEqual(counts[str(self.science_id)], {'total': 1, 'by_difficulty': {'2': 1}})
+        self.assertEqual(json.loads(self.client.get('/questions').data)['total_questions'], 3)
+        res = self.client.get(f'/categories/{self.art_id}/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], 2)
+
+    def test_category_stats_follow_move_after_insert(self):
+        """TEST category_stats move a question changed straight after its insert"""
+        with self.app.app_context():
+            question = Question(question='Moved', answer='A', category=self.science_id, difficulty=4)
+            question.insert()
+            question.category = self.art_id
+            question.update()
+
+        counts = json.loads(self.client.get('/categories?with_counts=1').data)['counts']
+        self.assertEqual(counts[str(self.art_id)], {'total': 2, 'by_difficulty': {'1': 1, '4': 1}})
+        self.assertEqual(counts[str(self.science_id)], {'total': 1, 'by_difficulty': {'2': 1}})
+
+    def test_get_questions_gzip(self):
+        """TEST GET /questions compresses large bodies when the client accepts gzip"""
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "COMPRESS_MIN_SIZE": 0,
+            "TESTING": True
+        })
+        res = app.test_client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        self.assertTrue(json.loads(gzip.decompress(res.data))['success'])
+
+        res = app.test_client().get('/questions', headers={'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
     def test_post_questions_creation(self):
         """TEST POST for /questions creation"""
         new_question = {
             "question": "What is the capital of California?",
             "answer": "Sacramento",
-            "category": 1,
+            "category": self.science_id,
             "difficulty": 2
         }
         res = self.client.post('/questions', json=new_question)
@@ -133,6 +402,75 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
 
 
+    def test_bulk_import_questions(self):
+        """TEST POST /questions/bulk inserts valid rows and reports the rest"""
+        with self.app.app_context():
+            category_id = Category.query.first().id
+        rows = [
+            {"question": "Bulk 1", "answer": "A", "category": category_id, "difficulty": 1},
+            {"question": "Bulk 2", "answer": "A", "category": category_id, "difficulty": 2},
+            {"question": "", "answer": "A", "category": category_id, "difficulty": 2},
+        ]
+        res = self.client.post('/questions/bulk', json=rows)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['errors'][0]['row'], 2)
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), 4)
+
+    def test_bulk_import_ndjson_abort_on_error(self):
+        """TEST POST /questions/bulk with on_error=abort inserts nothing on a bad row"""
+        body = json.dumps({"question": "Bulk", "answer": "A", "category": self.science_id, "difficulty": 1}) + '\nnot json\n'
+        res = self.client.post('/questions/bulk?on_error=abort', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'][0]['row'], 1)
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), 2)
+
+    def test_bulk_import_category_unknown_to_cache(self):
+        """TEST POST /questions/bulk accepts a category created after the cache was loaded"""
+        with self.app.app_context():
+            category_cache.types_by_id()
+            # a Core insert, like a write from another worker, leaves the cache as it is
+            category_id = db.session.execute(insert(Category).values(type='History')).inserted_primary_key[0]
+            db.session.commit()
+
+        res = self.client.post('/questions/bulk', json=[
+            {"question": "Bulk", "answer": "A", "category": category_id, "difficulty": 1}
+        ])
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['inserted'], 1)
+
+    def test_import_questions_command_abort_on_error(self):
+        """TEST flask import-questions --on-error abort fails without inserting"""
+        body = json.dumps({"question": "Bulk", "answer": "A", "category": self.science_id, "difficulty": 1}) + '\nnot json\n'
+        result = self.app.test_cli_runner().invoke(args=['import-questions', '-', '--on-error', 'abort'], input=body)
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('1 rows rejected, nothing inserted', result.output)
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), 2)
+
+    def test_export_questions_ndjson(self):
+        """TEST GET /questions/export streams every question as NDJSON"""
+        res = self.client.get('/questions/export?format=ndjson')
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['question'] for line in lines], ['Test question 1', 'Test question 2'])
+
+    def test_export_questions_unknown_format(self):
+        """TEST GET /questions/export rejects unknown formats"""
+        res = self.client.get('/questions/export?format=xml')
+
+        self.assertEqual(res.status_code, 400)
+
     def test_search_questions(self):
         """TEST POST for /questions search"""
         search_term = {
@@ -158,6 +496,37 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['questions']), 0)
 
+    def test_search_questions_substring_mode(self):
+        """TEST POST /questions search matches inside words in substring mode"""
+        res = self.client.post('/questions', json={"searchTerm": "estion 2", "searchMode": "substring"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['question'], 'Test question 2')
+
+    def test_search_questions_wildcards_are_literal(self):
+        """TEST POST /questions search does not treat % as a wildcard"""
+        res = self.client.post('/questions', json={"searchTerm": "%", "searchMode": "substring"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 0)
+
+    def test_fulltext_search_without_words_matches_nothing(self):
+        """Test fulltext_search only lists every question for an empty term"""
+        with self.app.app_context():
+            self.assertEqual(fulltext_search('--').all(), [])
+            self.assertEqual(fulltext_search('').count(), Question.query.count())
+
+    def test_search_questions_unknown_mode(self):
+        """TEST POST /questions search rejects an unknown searchMode"""
+        res = self.client.post('/questions', json={"searchTerm": "Test", "searchMode": "regex"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_search_questions_malformed_request(self):
         """TEST POST /questions search with invalid data structure"""
         invalid_search = {
@@ -172,7 +541,7 @@ class TriviaTestCase(unittest.TestCase):
 
     def test_categories_question_filter(self):
         """TEST GET for /categories/category_id/questions filter"""
-        res = self.client.get('/categories/1/questions')
+        res = self.client.get(f'/categories/{self.science_id}/questions')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -180,6 +549,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
        
 
+    def test_categories_question_filter_category_unknown_to_cache(self):
+        """TEST GET /categories/category_id/questions for a category created after the cache was loaded"""
+        self.client.get('/categories')
+        with self.app.app_context():
+            # a Core insert, like a write from another worker, leaves the cache as it is
+            category_id = db.session.execute(insert(Category).values(type='History')).inserted_primary_key[0]
+            db.session.commit()
+        self.create_question('History question', category=category_id)
+
+        res = self.client.get(f'/categories/{category_id}/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['current_category'], 'History')
+        self.assertEqual(data['total_questions'], 1)
+        self.assertLessEqual(self.app.extensions['query_tracker']['last_request'].count, 3)
+        # the lookup reloaded the cache, so the next request finds the category there
+        self.assertIn(category_id, category_cache.types_by_id())
+
     def test_categories_question_filter_404_errors(self):
         """TEST GET for /categories/category_id/questions nonexistent category"""
         res = self.client.get('/categories/9999/questions')  # Category that doesn't exist
@@ -189,6 +577,24 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_categories_question_filter_404_skips_question_queries(self):
+        """TEST GET /categories/category_id/questions checks the category before querying questions"""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            res = self.client.get('/categories/9999/questions')
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse([statement for statement in statements if 'FROM questions' in statement])
+
     def test_play_quiz_with_category(self):
         """Test POST /quizzes with specific category"""
         with self.app.app_context():
@@ -208,6 +614,39 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['question'])
         self.assertEqual(data['question']['category'], category_id)
 
+    def test_play_quiz_excludes_previous_questions(self):
+        """Test POST /quizzes never repeats a previous question"""
+        with self.app.app_context():
+            question_ids = [question.id for question in Question.query.all()]
+
+        res = self.client.post('/quizzes', json={"previous_questions": question_ids[:1], "quiz_category": None})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], question_ids[1])
+
+        res = self.client.post('/quizzes', json={"previous_questions": question_ids, "quiz_category": None})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question'], None)
+
+    def test_random_question_is_uniform_over_gapped_ids(self):
+        """Test random_question picks every remaining question equally often"""
+        category_id = self.create_category('Gapped')
+        question_ids = [self.create_question(f'Gapped {number}', category=category_id) for number in range(50)]
+        kept = [question_ids[0], question_ids[-2], question_ids[-1]]
+        with self.app.app_context():
+            for question in Question.query.filter(Question.category == category_id, Question.id.notin_(kept)):
+                question.delete()
+
+            random.seed(7)
+            picks = Counter(random_question(category_id).id for _ in range(300))
+
+        self.assertEqual(set(picks), set(kept))
+        for question_id in kept:
+            self.assertGreater(picks[question_id], 60)
+
     def test_quizz_invalid_key(self):
         """Test POST /quizzes with malformed request"""
         quiz_data = {
@@ -221,6 +660,254 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    def test_quiz_deck_is_reproducible(self):
+        """Test POST /quizzes/deck deals distinct questions and honours the seed"""
+        res = self.client.post('/quizzes/deck', json={"size": 2})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len({question['id'] for question in data['questions']}), 2)
+
+        res = self.client.post('/quizzes/deck', json={"size": 2, "seed": data['seed']})
+        self.assertEqual(json.loads(res.data)['questions'], data['questions'])
+
+    def test_quiz_deck_422_for_invalid_size(self):
+        """Test POST /quizzes/deck rejects an out of range size"""
+        res = self.client.post('/quizzes/deck', json={"size": 1000})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_quiz_session_plays_every_question_once(self):
+        """Test POST /quizzes/sessions and /next serve each question once"""
+        res = self.client.post('/quizzes/sessions', json={"quiz_category": None})
+        session_id = json.loads(res.data)['session_id']
+
+        played = []
+        for _ in range(3):
+            res = self.client.post(f'/quizzes/sessions/{session_id}/next')
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            if data['question']:
+                played.append(data['question']['id'])
+
+        self.assertEqual(len(played), 2)
+        self.assertEqual(len(set(played)), 2)
+        self.assertEqual(data['question'], None)
+
+    def test_quiz_session_does_not_bind_played_ids(self):
+        """Test POST /quizzes/sessions/id/next leaves played questions out of the query"""
+        res = self.client.post('/quizzes/sessions', json={"quiz_category": None})
+        session_id = json.loads(res.data)['session_id']
+        first = json.loads(self.client.post(f'/quizzes/sessions/{session_id}/next').data)['question']['id']
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            data = json.loads(self.client.post(f'/quizzes/sessions/{session_id}/next').data)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        self.assertNotEqual(data['question']['id'], first)
+        self.assertFalse([statement for statement in statements if 'NOT IN' in statement])
+
+    def test_quiz_session_404_for_unknown_session(self):
+        """Test POST /quizzes/sessions/id/next with an unknown session"""
+        res = self.client.post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_in_memory_bank_serves_reads_from_snapshot(self):
+        """Test IN_MEMORY_BANK serves listings without queries and follows writes"""
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "IN_MEMORY_BANK": True,
+            "TESTING": True
+        })
+        client = app.test_client()
+        expected = json.loads(self.client.get('/questions').data)
+
+        res = client.get('/questions')
+        self.assertEqual(json.loads(res.data), expected)
+        self.assertIsNone(app.extensions['query_tracker']['last_request'])
+
+        data = json.loads(client.post('/questions', json={"searchTerm": "question 2"}).data)
+        self.assertEqual([question['question'] for question in data['questions']], ['Test question 2'])
+
+        data = json.loads(client.post('/quizzes', json={"previous_questions": [], "quiz_category": {"id": self.art_id}}).data)
+        self.assertEqual(data['question']['category'], self.art_id)
+
+        self.create_question('Fresh question', category=self.art_id)
+        data = json.loads(client.get(f'/categories/{self.art_id}/questions').data)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual(data['questions'][-1]['question'], 'Fresh question')
+
+    def test_server_timing_when_enabled(self):
+        """Test TIMING_ENABLED adds Server-Timing headers and records requests"""
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "TIMING_ENABLED": True,
+            "TESTING": True
+        })
+        client = app.test_client()
+        res = client.get('/questions')
+
+        self.assertIn('total;dur=', res.headers['Server-Timing'])
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+
+        data = json.loads(client.get('/timings').data)
+        self.assertEqual(data['timings'][0]['endpoint'], 'get_questions')
+        self.assertTrue(data['timings'][0]['queries'])
+
+    def test_no_server_timing_by_default(self):
+        """Test timing is off unless enabled"""
+        res = self.client.get('/questions')
+
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertEqual(self.client.get('/timings').status_code, 404)
+
+    def test_metrics_counts_requests_and_errors(self):
+        """Test GET /metrics reports per-endpoint counts, errors and latency"""
+        self.client.get('/questions')
+        self.client.get('/questions?page=1000')
+        res = self.client.get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_http_requests_total{endpoint="get_questions",method="GET",status="200"} 1', text)
+        self.assertIn('trivia_http_request_errors_total{endpoint="get_questions",method="GET",status="404"} 1', text)
+        self.assertIn('trivia_http_request_duration_seconds_count{endpoint="get_questions",method="GET"} 2', text)
+        self.assertIn('trivia_db_pool_checkouts_total', text)
+
+    def test_metrics_aggregated_through_directory(self):
+        """Test METRICS_DIR sums the snapshots written by every worker"""
+        directory = tempfile.mkdtemp()
+        # an exited worker whose pid this process reused
+        with open(os.path.join(directory, f'metrics-{os.getpid()}.json'), 'w') as f:
+            json.dump({'pid': 1, 'requests': [['get_questions', 'GET', '200', 4]], 'latency': [], 'pool': {}}, f)
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "METRICS_DIR": directory,
+            "TESTING": True
+        })
+        client = app.test_client()
+        client.get('/questions')
+        text = client.get('/metrics').data.decode()
+
+        self.assertIn('trivia_http_requests_total{endpoint="get_questions",method="GET",status="200"} 5', text)
+        shutil.rmtree(directory)
+
+    def test_metrics_concurrent_snapshot_writes(self):
+        """Test concurrent flushes of one worker never fail or leave a partial file"""
+        directory = tempfile.mkdtemp()
+        registry = MetricsRegistry()
+        registry.observe('get_questions', 'GET', 200, 0.01)
+        errors = []
+
+        def flush():
+            try:
+                for _ in range(50):
+                    write_snapshot(directory, registry.snapshot(), {})
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=flush) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot, _ = read_snapshots(directory)
+        shutil.rmtree(directory)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(snapshot['requests'], {('get_questions', 'GET', '200'): 1})
+
+    def test_pool_counters_concurrent_increments(self):
+        """Test pool counters keep every increment made from many threads"""
+        counters = PoolCounters()
+
+        def checkout():
+            for _ in range(10000):
+                counters.increment('checkouts')
+
+        threads = [threading.Thread(target=checkout) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counters.snapshot()['checkouts'], 80000)
+
+    def test_questions_query_count(self):
+        """Test GET /questions runs at most 2 queries once categories are cached"""
+        self.client.get('/questions')
+        res = self.client.get('/questions')
+        stats = self.app.extensions['query_tracker']['last_request']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(stats.count, 2)
+
+    def test_query_tracking_survives_failed_statement(self):
+        """Test a statement that raises leaves no start time behind for the next one"""
+        with self.app.test_request_context('/questions'):
+            with self.assertRaises(Exception):
+                db.session.execute(text('SELECT * FROM no_such_table'))
+            db.session.rollback()
+            db.session.execute(text('SELECT 1'))
+            stats = request_query_stats()
+            connection_info = db.session.connection().info
+
+        self.assertEqual(stats.count, 1)
+        self.assertNotIn('query_start', connection_info)
+
+    def test_query_budget_fails_in_testing(self):
+        """Test a view over its query budget raises in testing mode"""
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "TESTING": True
+        })
+
+        @app.route('/over-budget')
+        @query_budget(0)
+        def over_budget():
+            return jsonify({"total": Question.query.count()})
+
+        with self.assertRaises(QueryBudgetExceeded):
+            app.test_client().get('/over-budget')
+
+    def test_health_reports_pool_status(self):
+        """Test GET /health exposes the connection pool statistics"""
+        self.client.get('/categories')
+        res = self.client.get('/health')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['pool']['checkouts'])
+        self.assertIn('checked_out', data['pool'])
+        self.assertIn('overflow', data['pool'])
+
+    def test_pool_settings_from_test_config(self):
+        """Test create_app passes pool settings through as engine options"""
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "DB_POOL_SIZE": 2,
+            "DB_POOL_RECYCLE": 60,
+            "TESTING": True
+        })
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+
+        self.assertEqual(options['pool_recycle'], 60)
+        if not self.database_path.startswith('sqlite'):
+            self.assertEqual(options['pool_size'], 2)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
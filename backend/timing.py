@@ -0,0 +1,87 @@
+import time
+from collections import deque
+
+from flask import g, has_request_context, jsonify, request
+
+from query_tracker import request_query_stats
+from settings import TIMING_ENABLED
+
+"""
+Per-request timing, switched on with the TIMING_ENABLED config key.
+
+Every request records its total handler time, the time spent in database
+statements and their count, and the time spent serializing JSON. The
+numbers are sent back in a Server-Timing header and the most recent
+TIMING_BUFFER_SIZE requests are kept in an in-process ring buffer, served
+by GET /timings.
+"""
+TIMING_BUFFER_SIZE = 1000
+
+
+def add_timing(name, seconds):
+    """
+    Adds to a per-request timer; a no-op outside requests or when timing
+    is disabled.
+    """
+    if has_request_context():
+        timings = g.get('timings')
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
+
+
+def start_request_timer():
+    g.timings = {'json': 0.0}
+    g.request_started = time.perf_counter()
+
+
+def server_timing_header(timings, total):
+    return ', '.join([
+        f'db;dur={timings["db"] * 1000:.2f};desc="{timings["queries"]} queries"',
+        f'json;dur={timings["json"] * 1000:.2f}',
+        f'total;dur={total * 1000:.2f}',
+    ])
+
+
+def init_timing(app):
+    if not app.config.get('TIMING_ENABLED', TIMING_ENABLED):
+        return
+
+    buffer = deque(maxlen=app.config.get('TIMING_BUFFER_SIZE', TIMING_BUFFER_SIZE))
+    app.extensions['timings'] = buffer
+
+    app.before_request(start_request_timer)
+
+    # registered before the other after_request hooks, so it runs last and
+    # the total includes them (e.g. compression)
+    @app.after_request
+    def record_request_timing(response):
+        timings = g.get('timings')
+        if timings is None:
+            return response
+        total = time.perf_counter() - g.request_started
+        # database time and statement count come from the query tracker
+        stats = request_query_stats()
+        timings['db'], timings['queries'] = stats.seconds, stats.count
+        response.headers['Server-Timing'] = server_timing_header(timings, total)
+        buffer.append({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 3),
+            'db_ms': round(timings['db'] * 1000, 3),
+            'queries': timings['queries'],
+            'json_ms': round(timings['json'] * 1000, 3),
+            'time': time.time(),
+        })
+        return response
+
+    @app.route('/timings', methods=["GET"])
+    def get_timings():
+        limit = request.args.get("limit", 100, type=int)
+        recent = list(buffer)[-limit:] if limit > 0 else []
+        return jsonify({
+            "success": True,
+            "timings": recent,
+            "total": len(buffer)
+        })